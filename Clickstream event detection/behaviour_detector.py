@@ -2,10 +2,12 @@ import quixstreams as qx
 import os
 import pandas as pd
 import logging
-from rlh import RedisStreamLogHandler
-import time
 import redis
+from log_shipper import RedisStreamLogShipper
 from rocksdict import Rdict
+from rule_engine import CombinedAutomaton
+from state_cache import StateCache
+from visitor_state import PatternMatch
 
 
 if 'window_minutes' not in os.environ:
@@ -13,16 +15,38 @@ if 'window_minutes' not in os.environ:
 else:
     window_minutes = int(os.environ['window_minutes'])
 
+# Behaviour patterns, in YAML or JSON. Patterns without a `window_minutes` use `window_minutes`
+patterns_file = os.environ['patterns_file'] if os.environ.get('patterns_file') \
+    else os.path.join(os.path.dirname(os.path.abspath(__file__)), "patterns.yaml")
+
+# Maximum number of visitor states kept in memory
+state_cache_size = int(os.environ['state_cache_size']) if os.environ.get('state_cache_size') else 100000
+
+# Updated visitor states are written to the state store every `state_flush_frames` frames or `state_flush_seconds`
+state_flush_frames = int(os.environ['state_flush_frames']) if os.environ.get('state_flush_frames') else 100
+state_flush_seconds = float(os.environ['state_flush_seconds']) if os.environ.get('state_flush_seconds') else 5
+
+# Visitors idle for longer than the window are deleted from the state store every `state_expiry_interval_seconds`,
+# `state_expiry_batch_size` at a time
+state_expiry_interval_seconds = float(os.environ['state_expiry_interval_seconds']) \
+    if os.environ.get('state_expiry_interval_seconds') else 60
+state_expiry_batch_size = int(os.environ['state_expiry_batch_size']) \
+    if os.environ.get('state_expiry_batch_size') else 1000
+
+# State logs are written to Redis from a background thread, `log_batch_size` at a time. Up to `log_queue_size` logs
+# wait to be written, newer ones are dropped. Only a `log_sample_rate` share of the logs is kept
+log_queue_size = int(os.environ['log_queue_size']) if os.environ.get('log_queue_size') else 10000
+log_batch_size = int(os.environ['log_batch_size']) if os.environ.get('log_batch_size') else 100
+log_sample_rate = float(os.environ['log_sample_rate']) if os.environ.get('log_sample_rate') else 1.0
+log_stream_maxlen = int(os.environ['log_stream_maxlen']) if os.environ.get('log_stream_maxlen') else 10
 
-def check_time_elapsed(row, current_state):
-    if len(current_state["rows"]) == 0:
-        return True
 
-    timestamp_row = row["timestamp"]
-    timestamp_first_interaction = current_state["rows"][0]["timestamp"]
-    window_ns = window_minutes * 60 * 1e9
+# Method to check a click is within the window of the first click of the current sequence
+def check_time_elapsed(timestamp: int, match: PatternMatch, window_ns: float):
+    if match.transitions == 0:
+        return True
 
-    time_valid = timestamp_row - timestamp_first_interaction < window_ns
+    time_valid = timestamp - match.first_timestamp < window_ns
     return time_valid
 
 
@@ -30,148 +54,207 @@ class BehaviourDetector:
     columns = ["time", "timestamp", "userId", "category", "age", "ip", "gender", "productId", "offer"]
     visitor_columns = ["userId", "offer", "category", "productId"]
 
-    transitions = {
-        "init": [
-            {
-                "condition": lambda row, current_state: row["category"] == "clothing"
-                                                        and ((row["gender"] == "M" and 35 <= row["age"] <= 45)
-                                                             or (row["gender"] == "F" and 25 <= row["age"] <= 35)),
-                "next_state": "clothes_visited",
-            }
-        ],
-        "clothes_visited": [
-            {
-                "condition": lambda row, current_state: row["category"] == "shoes",
-                "next_state": "shoes_visited"
-            },
-            {
-                "condition": lambda row, current_state: row["category"] == "clothing",
-                "next_state": "clothes_visited"
-            }
-        ],
-        "shoes_visited": [
-            {
-                "condition": lambda row, current_state: row["category"] == "clothing"
-                                                        and row["productId"] != current_state["rows"][0]["productId"],
-                "next_state": "offer"
-            },
-            {
-                "condition": lambda row, current_state: row["category"] == "clothing"
-                                                        and row["productId"] == current_state["rows"][0]["productId"],
-                "next_state": "clothes_visited"
-            }
-        ]
-    }
-
-    def __init__(self):
+    def __init__(self, state_path: str = "state/state.dict", log_handler: logging.Handler = None):
         self._special_offers_recipients = []
 
+        # All the patterns are compiled into one automaton, so each click is evaluated once for every pattern
+        self._automaton = CombinedAutomaton.from_file(patterns_file, window_minutes)
+        print(f"Loaded {len(self._automaton.patterns)} patterns from {patterns_file}")
+
+        # State logs are written to the `state_logs` Redis stream, unless another handler is given
         self.logger = logging.getLogger("States")
         self.log_stream_name = "state_logs"
-        redis_log_handler = RedisStreamLogHandler(stream_name=self.log_stream_name,
-                                                  host=os.environ['redis_host'],
-                                                  port=int(os.environ['redis_port']),
-                                                  password=os.environ['redis_password'],
-                                                  username=os.environ.get('redis_username'))
-        self.redis_client = redis.Redis(host=os.environ['redis_host'],
-                                        port=int(os.environ['redis_port']),
-                                        password=os.environ['redis_password'],
-                                        username=os.environ.get('redis_username'))
-        redis_log_handler.setLevel(logging.INFO)
-        self.logger.addHandler(redis_log_handler)
+        if log_handler is None:
+            self.redis_client = redis.Redis(host=os.environ['redis_host'],
+                                            port=int(os.environ['redis_port']),
+                                            password=os.environ['redis_password'],
+                                            username=os.environ.get('redis_username'))
+            log_handler = RedisStreamLogShipper(self.redis_client, self.log_stream_name, maxlen=log_stream_maxlen,
+                                                queue_size=log_queue_size, batch_size=log_batch_size,
+                                                sample_rate=log_sample_rate)
+        self.log_handler = log_handler
+        self.log_handler.setLevel(logging.INFO)
+        self.logger.addHandler(self.log_handler)
 
         # make sure the state dir exists
-        if not os.path.exists("state"):
-            os.makedirs("state")
+        state_dir = os.path.dirname(state_path)
+        if state_dir and not os.path.exists(state_dir):
+            os.makedirs(state_dir)
 
         # rocksDb is used to hold state, state.dict is in the `state` folder which is maintained for us by Quix
         # so we just init the rocks db using `state.dict` which will be loaded from the file system if it exists
-        self._db = Rdict("state/state.dict")
+        self._db = Rdict(state_path)
+
+        # The states of active visitors are kept in memory, and written to the store in batches.
+        # Visitors idle for longer than the longest window are expired, since their state would be reset on their next
+        # click
+        self._state = StateCache(self._db, max_size=state_cache_size, flush_frames=state_flush_frames,
+                                 flush_seconds=state_flush_seconds,
+                                 ttl_seconds=self._automaton.max_window_minutes() * 60)
+        self._state.expire_in_thread(state_expiry_interval_seconds, state_expiry_batch_size)
 
     # Method to process the incoming dataframe
     def process_dataframe(self, stream_consumer: qx.StreamConsumer, received_df: pd.DataFrame):
-        for label, row in received_df.iterrows():
-            user_id = row["userId"]
-            self.logger.debug(f"Processing frame for {user_id}")
+        # Filter out data that cannot apply for offers
+        if all(column in received_df.columns for column in self._automaton.columns):
+            self.process_rows(received_df)
+        else:
+            self.logger.debug("Frame does not have the columns of the patterns, ignoring")
+
+        self._state.frame_processed()
+
+    # Method to apply the transitions to the clicks of a frame, in order
+    def process_rows(self, received_df: pd.DataFrame):
+        automaton = self._automaton
+
+        # Every condition is evaluated once for the whole frame, so the rows only need looking up in the table
+        frame = {column: received_df[column].to_numpy() for column in automaton.columns}
+        met = automaton.evaluate(frame, len(received_df))
+
+        # Only log to info if it is a real user interaction (real user interactions do not have original_timestamp value)
+        log_level = logging.INFO if "original_timestamp" not in received_df.columns else logging.DEBUG
+
+        # Checked once per frame, so the logs are only built when they are kept
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        log_transitions = self.logger.isEnabledFor(log_level)
+
+        categories = received_df["category"].tolist() if "category" in received_df.columns \
+            else [None] * len(received_df)
+
+        for row, (user_id, product_id, timestamp, category, row_met) in enumerate(zip(
+                received_df["userId"].tolist(), received_df["productId"].tolist(),
+                received_df["timestamp"].tolist(), categories, met)):
+            if debug:
+                self.logger.debug("Processing frame for %s", user_id)
+
+            # Get state. States of other patterns start over
+            user_state = self._state.get(user_id)
+            if user_state.automaton != automaton.id:
+                user_state.automaton = automaton.id
+                user_state.matches = []
+
+            matches = []
+            changed = False
+
+            for match in user_state.matches:
+                # Ignore page refreshes
+                if match.last_product_id == product_id:
+                    if debug:
+                        self.logger.debug("Ignoring page refresh for %s", user_id)
+                    matches.append(match)
+                    continue
+
+                changed = True
 
-            # Filter out data that cannot apply for offers
-            if "gender" not in row:
-                self.logger.debug(f"User {user_id} does not have gender, ignoring")
+                # Transition to next state if condition is met, otherwise reset to initial state
+                pattern = automaton.state_patterns[match.state]
+                next_state = self.next_state(automaton.table[match.state], pattern, match, row_met, product_id,
+                                             timestamp)
+
+                if next_state is None:
+                    if debug:
+                        self.logger.debug("Resetting state to init for %s", user_id)
+                    continue
+
+                if not self.apply_transition(match, next_state, pattern, user_id, product_id, timestamp, category,
+                                             frame, row, log_transitions, log_level):
+                    matches.append(match)
+
+            # Patterns the visitor is in the initial state of start on the transitions out of it this click meets
+            started = None
+            for transition in row_met:
+                start = automaton.starts[transition]
+                if start is None:
+                    continue
+
+                pattern, same_product, next_state = start
+                if started is None:
+                    started = {automaton.state_patterns[match.state] for match in user_state.matches}
+                if pattern in started or same_product:
+                    continue
+
+                started.add(pattern)
+                changed = True
+
+                match = PatternMatch(next_state)
+                if not self.apply_transition(match, next_state, pattern, user_id, product_id, timestamp, category,
+                                             frame, row, log_transitions, log_level):
+                    matches.append(match)
+
+            # Save state
+            if changed:
+                user_state.matches = matches
+                self._state.set(user_id, user_state)
+
+    # Method to find the first transition of a state that a click meets the conditions of, within the window
+    def next_state(self, transitions: list, pattern: int, match: PatternMatch, row_met: list, product_id: str,
+                   timestamp: int):
+        window_ns = self._automaton.patterns[pattern][1]
+
+        for transition, same_product, next_state in transitions:
+            if transition not in row_met:
                 continue
 
-            if "age" not in row:
-                self.logger.debug(f"User {user_id} does not have age, ignoring")
+            if same_product is not None and (product_id == match.first_product_id) != same_product:
                 continue
 
-            # Get state
-            self.logger.debug(f"Getting state for {user_id}")
-            start = time.time()
-            if user_id not in self._db.keys():
-                self._db[user_id] = {}
-            user_state = self._db[user_id]
-            self.logger.debug(f"Loaded state for {user_id}. Took {time.time() - start} seconds")
+            if check_time_elapsed(timestamp, match, window_ns):
+                return next_state
 
-            # Initialize state if not present
-            user_state["offer"] = "offer1" if row["gender"] == 'M' else "offer2"
+        return None
 
-            if "state" not in user_state:
-                user_state["state"] = "init"
+    # Method to move a visitor to the next state of a pattern, and trigger the offer of the pattern at its end.
+    # Returns whether the pattern is complete
+    def apply_transition(self, match: PatternMatch, next_state: int, pattern: int, user_id: str, product_id: str,
+                         timestamp: int, category: str, frame: dict, row: int, log_transitions: bool, log_level: int):
+        automaton = self._automaton
 
-            if "rows" not in user_state:
-                user_state["rows"] = []
+        match.state = next_state
+        match.add_click(int(timestamp), product_id)
 
-            # Ignore page refreshes
-            if user_state["rows"] and user_state["rows"][-1]["productId"] == row["productId"]:
-                self.logger.debug(f"Ignoring page refresh for {user_id}")
-                continue
+        if log_transitions:
+            self.logger.log(log_level, "[User %s entered state %s][Event: clicked %s][Category: %s]",
+                            user_id, automaton.state_names[next_state], product_id, category)
 
-            # Transition to next state if condition is met
-            self.logger.debug(f"Applying transitions for {user_id}. Current state: {user_state['state']}")
-            transitioned = False
-            for transition in self.transitions[user_state["state"]]:
-                if transition["condition"](row, user_state) and check_time_elapsed(row, user_state):
-                    user_state["state"] = transition["next_state"]
-                    user_state["rows"].append(row)
-                    transitioned = True
-
-                    # Only log to info if it is a real user interaction (real user interactions do not have original_timestamp value)
-                    log_text = f"[User {user_id} entered state {user_state['state']}][Event: clicked {row['productId']}][Category: {row['category']}]"
-                    if "original_timestamp" not in row:
-                        self.logger.info(log_text)
-                    else:
-                        self.logger.debug(log_text)
-
-                    break
-
-            # Reset to initial state if no transition was made
-            if not transitioned:
-                self.logger.debug(f"Resetting state to init for {user_id}")
-                user_state["state"] = "init"
-                user_state["rows"] = []
-
-            # Trigger offer
-            elif user_state["state"] == "offer":
-                # Only log to info if it is a real user interaction (real user interactions do not have original_timestamp value)
-                log_text = f"[User {user_id} triggered offer {user_state['offer']}]"
-                if "original_timestamp" not in row:
-                    self.logger.info(log_text)
-                else:
-                    self.logger.debug(log_text)
-
-                user_state["state"] = "init"
-                user_state["rows"] = []
-                self._special_offers_recipients.append((user_id, user_state["offer"]))
+        if not automaton.final[next_state]:
+            return False
 
-            # Save state
-            self._db[user_id] = user_state
+        # Trigger offer
+        offer = automaton.offer(pattern, frame, row)
+        if log_transitions:
+            self.logger.log(log_level, "[User %s triggered offer %s]", user_id, offer)
 
-        # Finally, keep only the last 10 log entries
-        self.redis_client.xtrim(self.log_stream_name, maxlen=10, approximate=True)
+        self._special_offers_recipients.append((user_id, offer, int(timestamp)))
+        return True
 
     def get_special_offers_recipients(self) -> list:
-        """Return the recipients of the special offers."""
+        """Return the recipients of the special offers, as (visitor id, offer, click timestamp) tuples."""
         return self._special_offers_recipients
 
     def clear_special_offers_recipients(self):
         """Clear the recipients of the special offers."""
         self._special_offers_recipients = []
+
+    def get_state_stats(self) -> dict:
+        return self._state.stats()
+
+    def get_log_stats(self) -> dict:
+        return self.log_handler.stats()
+
+    def flush_state(self):
+        """Write the updated visitor states to the state store."""
+        self._state.flush()
+
+    def flush_logs(self):
+        """Wait until the queued state logs are written to Redis."""
+        self.log_handler.flush()
+
+    def get_stored_state_stats(self) -> dict:
+        """Return the number of visitor states in the state store, and their size."""
+        return self._state.stored_state_stats()
+
+    def close(self):
+        """Write the updated visitor states and close the state store."""
+        self._state.close()
+        self._db.close()
+        self.logger.removeHandler(self.log_handler)
@@ -0,0 +1,283 @@
+"""Replay benchmark of the behaviour detector, without a Quix workspace or Redis.
+
+The detector runs with the same code as the service, against a temporary state store and a local log sink. Enriched
+frames are either synthetic, built from the products and users of the Lookup data ingestion job, or derived from an
+omniture click log (--omniture) enriched with the same data. Every combination of frame size and visitor count is
+replayed, and rows/sec, p50 and p99 time per frame, offers emitted and state bytes per visitor are reported and saved
+as JSON.
+
+With --baseline, the results are compared with a previous run, and the benchmark fails when a scenario is slower,
+stores more bytes per visitor or emits different offers. --save-baseline stores the results as the new baseline.
+
+    python benchmark.py --frame-sizes 1,10,100 --visitors 1000,100000 --baseline benchmark_baseline.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from behaviour_detector import BehaviourDetector
+
+lookup_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Lookup data ingestion")
+
+# Metrics compared with the baseline, and whether higher values are better
+baseline_metrics = {
+    "rows_per_second": True,
+    "p99_frame_ms": False,
+    "state_bytes_per_visitor": False,
+}
+
+
+class LocalLogSink(logging.Handler):
+    """Counts the state logs instead of writing them to Redis. Messages are still formatted, as they would be."""
+
+    def __init__(self):
+        super().__init__()
+        self.records = 0
+
+    def emit(self, record: logging.LogRecord):
+        record.getMessage()
+        self.records += 1
+
+    def stats(self) -> dict:
+        return {"records": self.records}
+
+
+# Load the products and users the same way the Lookup data ingestion job does
+def load_lookup_data(lookup_dir: str):
+    products = pd.read_json(os.path.join(lookup_dir, "products.json"))
+    users = pd.read_json(os.path.join(lookup_dir, "users.json"), lines=True)
+
+    # A few users are in the file twice, only the first one is kept
+    users = users.drop_duplicates("userId").set_index("userId")
+
+    return products.drop_duplicates("id").set_index("id")["category"], users
+
+
+# Add the columns the enrichment service adds and the detector reads
+def enrich(df: pd.DataFrame, categories: pd.Series, users: pd.DataFrame, now: pd.Timestamp) -> pd.DataFrame:
+    birthdates = pd.to_datetime(df["userId"].map(users["birthDate"]), errors="coerce")
+
+    df["category"] = df["productId"].map(categories).fillna("Unknown")
+    df["gender"] = df["userId"].map(users["gender"]).fillna("U").str[0]
+    df["age"] = ((now - birthdates).dt.days // 365.25).to_numpy()
+    return df
+
+
+class SyntheticClicks:
+    """Builds `rows` clicks of `visitors` visitors, each one with the gender and birth date of one of the users.
+
+    Clicks come from `sessions` visitors browsing at the same time. A session lasts 5 clicks on average, then another
+    visitor starts browsing. The clicks are generated once, from `seed`, so every frame size replays the same clicks."""
+
+    def __init__(self, categories: pd.Series, users: pd.DataFrame, visitors: int, rows: int, seed: int,
+                 sessions: int = 100):
+        self.random = random.Random(seed)
+
+        # Visitors beyond the number of users reuse their data
+        known = users.index.tolist()
+        visitor_ids = [known[i] if i < len(known) else f"{known[i % len(known)]}-{i // len(known)}"
+                       for i in range(visitors)]
+        visitor_users = users.iloc[[i % len(known) for i in range(visitors)]].set_index(
+            pd.Index(visitor_ids, name="userId"))
+
+        product_ids = categories.index.tolist()
+        self.sessions = [self.random.choice(visitor_ids) for _ in range(min(sessions, visitors))]
+
+        user_ids = []
+        for _ in range(rows):
+            session = self.random.randrange(len(self.sessions))
+            user_ids.append(self.sessions[session])
+
+            if self.random.random() < 0.2:
+                self.sessions[session] = self.random.choice(visitor_ids)
+
+        # A click every 10 milliseconds
+        start = pd.Timestamp.now().value
+        self.clicks = enrich(pd.DataFrame({
+            "timestamp": [start + i * 10 ** 7 for i in range(rows)],
+            "userId": user_ids,
+            "productId": [self.random.choice(product_ids) for _ in range(rows)],
+        }), categories, visitor_users, pd.Timestamp.now())
+
+    def frames(self, frame_size: int, rows: int):
+        for start in range(0, min(rows, len(self.clicks)), frame_size):
+            yield self.clicks.iloc[start:start + frame_size].reset_index(drop=True)
+
+
+class OmnitureClicks:
+    """Replays the clicks of an omniture log, keeping the clicks of its first `visitors` visitors."""
+
+    def __init__(self, path: str, categories: pd.Series, users: pd.DataFrame, visitors: int, rows: int):
+        clicks = pd.read_csv(path, sep="\t", usecols=["Unix Timestamp", "Visitor Unique ID", "Product Page URL"],
+                             dtype={"Unix Timestamp": "int64", "Visitor Unique ID": "str", "Product Page URL": "str"})
+        clicks["userId"] = clicks["Visitor Unique ID"].str.strip("{}")
+
+        clicks = clicks[clicks["userId"].isin(clicks["userId"].unique()[:visitors])].head(rows)
+        product_ids = clicks["Product Page URL"].str.extract(r"http://www.acme.com/(\w+)/(\w+)", expand=True)[1]
+
+        self.clicks = enrich(pd.DataFrame({
+            "timestamp": clicks["Unix Timestamp"].to_numpy() * 10 ** 9,
+            "original_timestamp": clicks["Unix Timestamp"].to_numpy(),
+            "userId": clicks["userId"].to_numpy(),
+            "productId": product_ids.fillna(clicks["Product Page URL"]).to_numpy(),
+        }), categories, users, pd.Timestamp.now())
+
+    def frames(self, frame_size: int, rows: int):
+        for start in range(0, min(rows, len(self.clicks)), frame_size):
+            yield self.clicks.iloc[start:start + frame_size].reset_index(drop=True)
+
+
+def run_scenario(clicks, source: str, frame_size: int, visitors: int, rows: int):
+    frames = list(clicks.frames(frame_size, rows))
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        log_sink = LocalLogSink()
+        detector = BehaviourDetector(state_path=os.path.join(state_dir, "state.dict"), log_handler=log_sink)
+
+        offers = 0
+        frame_seconds = []
+        for df in frames:
+            start = time.perf_counter()
+            detector.process_dataframe(None, df)
+            offers += len(detector.get_special_offers_recipients())
+            detector.clear_special_offers_recipients()
+            frame_seconds.append(time.perf_counter() - start)
+
+        detector.flush_state()
+        stored = detector.get_stored_state_stats()
+        detector.close()
+
+    total_rows = sum(len(df) for df in frames)
+    return {
+        "source": source,
+        "frame_size": frame_size,
+        "visitors": visitors,
+        "frames": len(frames),
+        "rows": total_rows,
+        "seconds": sum(frame_seconds),
+        "rows_per_second": total_rows / sum(frame_seconds),
+        "p50_frame_ms": float(np.percentile(frame_seconds, 50)) * 1000,
+        "p99_frame_ms": float(np.percentile(frame_seconds, 99)) * 1000,
+        "offers": offers,
+        "state_logs": log_sink.records,
+        "stored_visitors": stored["stored_visitors"],
+        "state_bytes_per_visitor": stored["stored_state_bytes"] / stored["stored_visitors"]
+        if stored["stored_visitors"] else 0,
+    }
+
+
+def scenario_key(result: dict) -> tuple:
+    return result["source"], result["frame_size"], result["visitors"]
+
+
+# Method to list the scenarios that regressed past the tolerance, compared with the baseline
+def compare_with_baseline(results: list, baseline: list, tolerance: float) -> list:
+    baseline = {scenario_key(result): result for result in baseline}
+    regressions = []
+
+    for result in results:
+        previous = baseline.get(scenario_key(result))
+        if previous is None:
+            continue
+
+        name = "{} frame size {}, {} visitors".format(*scenario_key(result))
+
+        for metric, higher_is_better in baseline_metrics.items():
+            value, limit = result[metric], previous[metric]
+            if (value < limit * (1 - tolerance)) if higher_is_better else (value > limit * (1 + tolerance)):
+                regressions.append(f"{name}: {metric} {value:.1f}, baseline {limit:.1f}")
+
+        # The same clicks must trigger the same offers
+        if result["rows"] == previous["rows"] and result["offers"] != previous["offers"]:
+            regressions.append(f"{name}: {result['offers']} offers, baseline {previous['offers']}")
+
+    return regressions
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the behaviour detector against replayed frames")
+    parser.add_argument("--frame-sizes", default="1,10,100", help="Comma separated rows per frame")
+    parser.add_argument("--visitors", default="1000,100000", help="Comma separated number of visitors")
+    parser.add_argument("--rows", type=int, default=20000, help="Rows replayed per scenario")
+    parser.add_argument("--omniture", help="Omniture click log to replay instead of synthetic clicks")
+    parser.add_argument("--lookup-dir", default=lookup_data_dir,
+                        help="Directory of the products.json and users.json the clicks are enriched with")
+    parser.add_argument("--log-level", default="INFO", help="Level of the logs, INFO skips the per-click debug logs")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file the results are saved to")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare the results with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative change allowed from the baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the baseline")
+    args = parser.parse_args()
+
+    # Logs are only counted by the log sink, not printed
+    logging.getLogger().setLevel(args.log_level)
+
+    print("Loading lookup data")
+    categories, users = load_lookup_data(args.lookup_dir)
+    source = "omniture" if args.omniture else "synthetic"
+
+    results = []
+    for visitors in [int(count) for count in args.visitors.split(",")]:
+        # Every frame size replays the same clicks
+        clicks = OmnitureClicks(args.omniture, categories, users, visitors, args.rows) if args.omniture \
+            else SyntheticClicks(categories, users, visitors, args.rows, args.seed)
+
+        for frame_size in [int(size) for size in args.frame_sizes.split(",")]:
+            result = run_scenario(clicks, source, frame_size, visitors, args.rows)
+            results.append(result)
+
+            print(f"frame size {frame_size:>5}, {visitors:>7} visitors: {result['rows_per_second']:>10.0f} rows/sec, "
+                  f"p50 {result['p50_frame_ms']:.2f} ms, p99 {result['p99_frame_ms']:.2f} ms per frame, "
+                  f"{result['offers']} offers, {result['state_bytes_per_visitor']:.0f} bytes per visitor")
+
+    output = {
+        "commit": get_commit(),
+        "date": datetime.utcnow().isoformat(),
+        "rows": args.rows,
+        "seed": args.seed,
+        "results": results,
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(output, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+
+    elif args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f)["results"], args.tolerance)
+
+        if regressions:
+            print("Regressions from the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+
+        print("No regressions from the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import logging
+import queue
+import random
+import threading
+
+import redis
+
+
+class RedisStreamLogShipper(logging.Handler):
+    """Logging handler writing records to a Redis stream from a background thread.
+
+    Records are put on a bounded queue, and dropped when it is full, so logging never waits for Redis. The thread
+    formats them and writes up to `batch_size` at a time with a single pipeline of `XADD ... MAXLEN ~ maxlen`. Only a
+    `sample_rate` share of the records is kept. Entries have the same `msg`, `levelname` and `created` fields as the
+    ones written by `rlh.RedisStreamLogHandler`."""
+
+    def __init__(self, redis_client: redis.Redis, stream_name: str, maxlen: int = 10, queue_size: int = 10000,
+                 batch_size: int = 100, sample_rate: float = 1.0):
+        super().__init__()
+        self.redis_client = redis_client
+        self.stream_name = stream_name
+        self.maxlen = maxlen
+        self.batch_size = batch_size
+        self.sample_rate = sample_rate
+
+        self._queue = queue.Queue(maxsize=queue_size)
+
+        self.shipped = 0
+        self.dropped = 0
+
+        self._thread = threading.Thread(target=self._run, name="ship-logs", daemon=True)
+        self._thread.start()
+
+    def emit(self, record: logging.LogRecord):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+
+            # Take whatever else is queued, up to a batch
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self._ship(records)
+
+            for _ in records:
+                self._queue.task_done()
+
+    def _ship(self, records: list):
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for record in records:
+                pipe.xadd(self.stream_name,
+                          {"msg": record.getMessage(), "levelname": record.levelname, "created": record.created},
+                          maxlen=self.maxlen, approximate=True)
+            pipe.execute()
+            self.shipped += len(records)
+        except Exception as e:
+            self.dropped += len(records)
+            print("Error shipping logs:", e)
+
+    def flush(self):
+        """Wait until the queued records are written."""
+        self._queue.join()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "shipped": self.shipped,
+            "dropped": self.dropped,
+        }
@@ -2,15 +2,18 @@ import quixstreams as qx
 import os
 import pandas as pd
 from behaviour_detector import BehaviourDetector
+from offer_dispatcher import OfferDispatcher
+from stream_pool import StreamPool
 import logging
 
 # Quix injects credentials automatically to the client.
 # Alternatively, you can always pass an SDK token manually as an argument.
 client = qx.QuixStreamingClient()
 
+# Set `log_level` to INFO or above to skip the per-click debug logs
 logger = logging.getLogger()
 logger.addHandler(logging.StreamHandler())
-logger.setLevel(logging.DEBUG)
+logger.setLevel(os.environ['log_level'] if os.environ.get('log_level') else logging.DEBUG)
 
 logger.info("Opening input and output topics")
 consumer_topic = client.get_topic_consumer(os.environ["input"])
@@ -19,17 +22,31 @@ producer_topic = client.get_topic_producer(os.environ["output"])
 behaviour_detector = BehaviourDetector()
 frames_received = 0
 
+# Offer streams are kept open while their visitor is active, and closed when idle or when the pool is full
+stream_pool = StreamPool(
+    producer_topic,
+    max_size=int(os.environ['stream_pool_size']) if os.environ.get('stream_pool_size') else 10000,
+    idle_seconds=float(os.environ['stream_idle_seconds']) if os.environ.get('stream_idle_seconds') else 1800)
 
-# Send special offers for each visitor in its own stream
-def send_special_offers(special_offers: list):
-    for visitor_id, offer in special_offers:
-        logger.info(f"Sending offer to visitor {visitor_id}")
 
-        # Use the visitor ID as the stream name
-        stream = producer_topic.get_or_create_stream(visitor_id)
+# Send a special offer to a visitor in its own stream
+def send_special_offer(visitor_id: str, offer: str):
+    logger.info("Sending offer to visitor %s", visitor_id)
 
-        # Send the offer to the stream
-        stream.events.publish(qx.EventData("offer", pd.Timestamp.utcnow(), offer))
+    # Use the visitor ID as the stream name
+    stream = stream_pool.get_stream(visitor_id)
+
+    # Send the offer to the stream
+    stream.events.publish(qx.EventData("offer", pd.Timestamp.utcnow(), offer))
+
+
+# Offers are sent from a background thread, in batches, and at most once per visitor within `offer_dedupe_seconds`
+offer_dispatcher = OfferDispatcher(
+    send_special_offer,
+    batch_size=int(os.environ['offer_batch_size']) if os.environ.get('offer_batch_size') else 100,
+    flush_seconds=float(os.environ['offer_flush_seconds']) if os.environ.get('offer_flush_seconds') else 0.5,
+    dedupe_seconds=float(os.environ['offer_dedupe_seconds']) if os.environ.get('offer_dedupe_seconds') else 60,
+    queue_size=int(os.environ['offer_queue_size']) if os.environ.get('offer_queue_size') else 10000)
 
 
 # Callback called for each incoming dataframe
@@ -37,7 +54,10 @@ def on_dataframe_handler(stream_consumer: qx.StreamConsumer, df: pd.DataFrame):
     global frames_received
     frames_received += 1
     if frames_received % 100 == 0:
-        logger.debug(f"Received {frames_received} frames")
+        logger.debug("Received %s frames. State cache: %s. State logs: %s. Offers: %s. Output streams: %s open, "
+                     "%s closed", frames_received, behaviour_detector.get_state_stats(),
+                     behaviour_detector.get_log_stats(), offer_dispatcher.stats(), stream_pool.size(),
+                     stream_pool.closed)
 
     # Original dataframe may contain more than one row
     logger.debug("Processing dataframe")
@@ -48,10 +68,19 @@ def on_dataframe_handler(stream_consumer: qx.StreamConsumer, df: pd.DataFrame):
     special_offers = behaviour_detector.get_special_offers_recipients()
 
     if len(special_offers) > 0:
-        send_special_offers(special_offers)
+        offer_dispatcher.submit(special_offers)
         behaviour_detector.clear_special_offers_recipients()
 
 
+# Write the visitor states still in memory and the queued state logs, send the queued offers and close the offer
+# streams before shutting down
+def before_shutdown():
+    behaviour_detector.flush_state()
+    behaviour_detector.flush_logs()
+    offer_dispatcher.stop()
+    stream_pool.close_all()
+
+
 # Callback called for each incoming stream
 def read_stream(consumer_stream: qx.StreamConsumer):
     # React to new data received from input topic.
@@ -66,4 +95,4 @@ if __name__ == "__main__":
 
     # Hook up to termination signal (for docker image) and CTRL-C
     # And handle graceful exit of the model.
-    qx.App.run()
+    qx.App.run(before_shutdown=before_shutdown)
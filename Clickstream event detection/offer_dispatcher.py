@@ -0,0 +1,124 @@
+import queue
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class OfferDispatcher:
+    """Publishes offers from a background thread, in batches.
+
+    Offers are gathered across frames and published when `batch_size` visitors are waiting or `flush_seconds` after the
+    first one was queued, whichever comes first. A visitor gets at most one offer per `dedupe_seconds`, later ones are
+    dropped. When `queue_size` offers are waiting, `submit` blocks, which slows down consumption instead of buffering
+    without limit.
+
+    The latency of each offer, from the timestamp of the click that triggered it to its publication, is kept for the
+    last `latency_samples` offers."""
+
+    def __init__(self, publish, batch_size: int, flush_seconds: float, dedupe_seconds: float, queue_size: int,
+                 latency_samples: int = 10000):
+        self.publish = publish
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.dedupe_seconds = dedupe_seconds
+
+        self._queue = queue.Queue(maxsize=queue_size)
+
+        # visitor id -> time of its last offer. Oldest offers are first
+        self._last_sent = {}
+        self._latencies_ms = deque(maxlen=latency_samples)
+        self._latencies_lock = threading.Lock()
+
+        self.sent = 0
+        self.deduplicated = 0
+        self.batches = 0
+
+        self._thread = threading.Thread(target=self._run, name="dispatch-offers", daemon=True)
+        self._thread.start()
+
+    def submit(self, offers: list):
+        """Queue (visitor id, offer, click timestamp in nanoseconds) tuples. Blocks while the queue is full."""
+        for offer in offers:
+            self._queue.put(offer)
+
+    def _run(self):
+        # visitor id -> (offer, click timestamp), for the offers of the next batch
+        pending = {}
+        deadline = None
+
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+
+            # Sentinel put by stop
+            if item is None:
+                if pending:
+                    self._flush(pending)
+                return
+
+            if item:
+                visitor_id, offer, timestamp = item
+
+                if visitor_id in pending:
+                    self.deduplicated += 1
+                else:
+                    pending[visitor_id] = (offer, timestamp)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_seconds
+
+            if pending and (len(pending) >= self.batch_size or time.monotonic() >= deadline):
+                self._flush(pending)
+                pending = {}
+                deadline = None
+
+    def _flush(self, pending: dict):
+        now = time.monotonic()
+
+        # Forget the visitors whose last offer is out of the window
+        while self._last_sent:
+            visitor_id, sent_at = next(iter(self._last_sent.items()))
+            if now - sent_at < self.dedupe_seconds:
+                break
+            del self._last_sent[visitor_id]
+
+        for visitor_id, (offer, timestamp) in pending.items():
+            if visitor_id in self._last_sent:
+                self.deduplicated += 1
+                continue
+
+            try:
+                self.publish(visitor_id, offer)
+            except Exception as e:
+                print(f"Error sending offer to visitor {visitor_id}:", e)
+                continue
+
+            self._last_sent[visitor_id] = now
+            with self._latencies_lock:
+                self._latencies_ms.append((time.time_ns() - timestamp) / 1e6)
+            self.sent += 1
+
+        self.batches += 1
+
+    def stop(self):
+        """Publish the queued offers and stop the dispatcher thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self) -> dict:
+        with self._latencies_lock:
+            latencies = np.array(self._latencies_ms)
+
+        return {
+            "queued": self._queue.qsize(),
+            "sent": self.sent,
+            "deduplicated": self.deduplicated,
+            "batches": self.batches,
+            "latency_p50_ms": round(float(np.percentile(latencies, 50)), 1) if len(latencies) else None,
+            "latency_p99_ms": round(float(np.percentile(latencies, 99)), 1) if len(latencies) else None,
+        }
@@ -0,0 +1,209 @@
+import json
+import zlib
+
+import numpy as np
+import yaml
+
+# Every pattern starts in the `init` state, and reaching the `offer` state emits the offer of the pattern
+initial_state = "init"
+final_state = "offer"
+
+
+# Method to load the pattern definitions from a YAML or JSON file
+def load_patterns(path: str) -> dict:
+    with open(path) as f:
+        if path.endswith(".json"):
+            return json.load(f)
+
+        return yaml.safe_load(f)
+
+
+# Method to turn a predicate into a function of a frame, given as a dict of numpy arrays, that returns a boolean array.
+# The columns the predicate looks at are added to `columns`
+def compile_predicate(spec: dict, columns: set):
+    if not isinstance(spec, dict) or not spec:
+        raise ValueError(f"Invalid predicate: {spec!r}")
+
+    tests = []
+    for key, value in spec.items():
+        if key == "any":
+            tests.append(_any_of([compile_predicate(item, columns) for item in value]))
+        elif key == "all":
+            tests.append(_all_of([compile_predicate(item, columns) for item in value]))
+        elif key == "not":
+            tests.append(_none_of([compile_predicate(value, columns)]))
+        else:
+            columns.add(key)
+            tests.append(_column_test(key, value))
+
+    return tests[0] if len(tests) == 1 else _all_of(tests)
+
+
+def _any_of(tests: list):
+    return lambda frame: np.logical_or.reduce([test(frame) for test in tests])
+
+
+def _all_of(tests: list):
+    return lambda frame: np.logical_and.reduce([test(frame) for test in tests])
+
+
+def _none_of(tests: list):
+    return lambda frame: ~np.logical_or.reduce([test(frame) for test in tests])
+
+
+# A value is compared for equality, a list of values for membership, and a dict gives an inclusive `min` and `max`,
+# values `in` a list or a value the column must `not` be equal to
+def _column_test(column: str, value):
+    if isinstance(value, list):
+        return _any_of([_column_test(column, item) for item in value])
+
+    if not isinstance(value, dict):
+        return lambda frame: frame[column] == value
+
+    tests = []
+    for key, bound in value.items():
+        if key == "min":
+            tests.append(lambda frame, bound=bound: frame[column].astype(float) >= bound)
+        elif key == "max":
+            tests.append(lambda frame, bound=bound: frame[column].astype(float) <= bound)
+        elif key == "in":
+            tests.append(_column_test(column, list(bound)))
+        elif key == "not":
+            tests.append(_none_of([_column_test(column, bound)]))
+        else:
+            raise ValueError(f"Invalid test {key!r} on column {column!r}")
+
+    return _all_of(tests)
+
+
+# Method to turn the `steps` of a pattern into transitions: each step leads to the next one, and the last to the offer
+def steps_to_transitions(steps: list) -> dict:
+    transitions = {}
+
+    for index, step in enumerate(steps):
+        state = initial_state if index == 0 else f"step{index}"
+        next_state = final_state if index == len(steps) - 1 else f"step{index + 1}"
+        transitions[state] = [{**step, "next_state": next_state}]
+
+    return transitions
+
+
+class CombinedAutomaton:
+    """All the behaviour patterns, compiled into one automaton.
+
+    The states of every pattern are numbered together, after the initial state (code 0), which all the patterns share.
+    A visitor is in at most one state of each pattern, and in the initial state of the patterns it is not part way
+    through. The transitions out of the initial state are only tried for those patterns, and the transitions out of
+    the other states belong to their pattern, so the work per click depends on the transitions the click meets and
+    the patterns the visitor is part way through, not on the number of patterns.
+
+    Conditions are shared by all the patterns, and each one is evaluated once per frame."""
+
+    def __init__(self, definitions: dict, default_window_minutes: float):
+        # Changing the patterns changes the state codes, so states stored for other patterns start over
+        self.id = zlib.crc32(json.dumps(definitions, sort_keys=True).encode())
+
+        self.columns = set()
+        named_conditions = definitions.get("conditions") or {}
+        condition_indices = {}
+        self._conditions = []
+
+        # Named conditions are compiled once, and so are identical inline conditions
+        def condition_index(condition) -> int:
+            key = condition if isinstance(condition, str) else json.dumps(condition, sort_keys=True)
+
+            if key not in condition_indices:
+                spec = named_conditions[condition] if isinstance(condition, str) else condition
+                self._conditions.append(compile_predicate(spec, self.columns))
+                condition_indices[key] = len(condition_indices)
+
+            return condition_indices[key]
+
+        # The name, window in nanoseconds and offer of each pattern
+        self.patterns = []
+
+        # For each state code, its name, its pattern and whether it is the final state of its pattern
+        self.state_names = [initial_state]
+        self.state_patterns = [None]
+        self.final = [False]
+
+        # For each state code, its transitions as (transition index, same product, next state code). Transitions out of
+        # the initial state are kept by transition index instead, as (pattern index, same product, next state code)
+        self.table = [[]]
+        self.starts = []
+        transition_conditions = []
+
+        for pattern_index, pattern in enumerate(definitions["patterns"]):
+            offer = pattern["offer"]
+            if isinstance(offer, dict):
+                self.columns.add(offer["column"])
+
+            window_minutes = pattern.get("window_minutes", default_window_minutes)
+            self.patterns.append((pattern["name"], window_minutes * 60 * 1e9, offer))
+
+            transitions = pattern["transitions"] if "transitions" in pattern else steps_to_transitions(pattern["steps"])
+
+            state_codes = {initial_state: 0}
+            for state in [*transitions, *(t["next_state"] for ts in transitions.values() for t in ts)]:
+                if state not in state_codes:
+                    state_codes[state] = len(self.state_names)
+                    self.state_names.append(state)
+                    self.state_patterns.append(pattern_index)
+                    self.final.append(state == final_state)
+                    self.table.append([])
+
+            for state, state_transitions in transitions.items():
+                for transition in state_transitions:
+                    index = len(transition_conditions)
+                    same_product = transition.get("same_product")
+                    next_state = state_codes[transition["next_state"]]
+
+                    if next_state == 0:
+                        raise ValueError(f"Pattern {pattern['name']!r} has a transition to {initial_state!r}")
+
+                    if state == initial_state:
+                        self.starts.append((pattern_index, same_product, next_state))
+                    else:
+                        self.starts.append(None)
+                        self.table[state_codes[state]].append((index, same_product, next_state))
+
+                    transition_conditions.append([condition_index(c) for c in transition.get("conditions", [])])
+
+        # Which conditions each transition needs, as a matrix, so the transitions a frame meets are found with one
+        # product of matrices
+        self._needs = np.zeros((len(transition_conditions), len(self._conditions)), dtype=np.int32)
+        for index, conditions in enumerate(transition_conditions):
+            self._needs[index, conditions] = 1
+
+        self.columns = sorted(self.columns)
+
+    @classmethod
+    def from_file(cls, path: str, default_window_minutes: float) -> "CombinedAutomaton":
+        return cls(load_patterns(path), default_window_minutes)
+
+    def evaluate(self, frame: dict, rows: int) -> list:
+        """Return the indices of the transitions each row of the frame meets the conditions of, in order."""
+        unmet = np.zeros((len(self._conditions), rows), dtype=np.int32)
+        for index, condition in enumerate(self._conditions):
+            unmet[index] = ~np.broadcast_to(np.asarray(condition(frame), dtype=bool), rows)
+
+        # A transition is met when none of its conditions are unmet
+        met_rows, met_transitions = np.nonzero((self._needs @ unmet).T == 0)
+
+        met = [[] for _ in range(rows)]
+        for row, transition in zip(met_rows.tolist(), met_transitions.tolist()):
+            met[row].append(transition)
+
+        return met
+
+    def offer(self, pattern: int, frame: dict, row: int) -> str:
+        """Return the offer a pattern emits for a row of the frame."""
+        offer = self.patterns[pattern][2]
+
+        if not isinstance(offer, dict):
+            return offer
+
+        return offer.get("values", {}).get(frame[offer["column"]][row], offer.get("default"))
+
+    def max_window_minutes(self) -> float:
+        return max((window for _, window, _ in self.patterns), default=0) / 60 / 1e9
@@ -0,0 +1,236 @@
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from rocksdict import Rdict, WriteBatch
+
+from visitor_state import VisitorState
+
+# Visitors are indexed by the minute they were last active in
+activity_bucket_seconds = 60
+
+# Column family of the state store holding the activity index
+activity_column_family = "activity"
+
+
+# Activity index keys are the bucket, big-endian so they sort by time, followed by the visitor id
+def activity_key(bucket: int, user_id: str) -> bytes:
+    return struct.pack(">q", bucket) + user_id.encode()
+
+
+class StateCache:
+    """Write-back cache of visitor states, in front of the RocksDB state store.
+
+    States are read from the store with point lookups, only when they are not cached. Updated states are kept in memory
+    and written to the store in one batch every `flush_frames` frames or `flush_seconds` seconds, whichever comes first.
+    When more than `max_size` states are cached, the least recently used ones are dropped, after writing them if needed.
+
+    Visitors are also indexed by the time bucket they were last active in, so the states of visitors idle for more than
+    `ttl_seconds` can be found and expired without scanning the whole store."""
+
+    def __init__(self, db: Rdict, max_size: int, flush_frames: int, flush_seconds: float, ttl_seconds: float):
+        self._db = db
+        self.max_size = max_size
+        self.flush_frames = flush_frames
+        self.flush_seconds = flush_seconds
+        self.ttl_seconds = ttl_seconds
+
+        try:
+            self._index = db.get_column_family(activity_column_family)
+            self._index_handle = db.get_column_family_handle(activity_column_family)
+        except Exception:
+            self._index = db.create_column_family(activity_column_family)
+            self._index_handle = db.get_column_family_handle(activity_column_family)
+            self._index_existing_states()
+
+        # visitor id -> state. Most recently used states are at the end
+        self._states = OrderedDict()
+        self._dirty = set()
+
+        # Writes to the store and expiry do not interleave
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._expiry_thread = None
+
+        self._frames = 0
+        self._last_flush = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.expired = 0
+
+    def _index_existing_states(self, batch_size: int = 10000):
+        # States stored before the index existed are indexed as if their visitors were active now
+        bucket = int(time.time() // activity_bucket_seconds)
+        batch = WriteBatch()
+        indexed = 0
+
+        for user_id in self._db.keys():
+            batch.put(activity_key(bucket, user_id), b"", self._index_handle)
+            indexed += 1
+
+            if indexed % batch_size == 0:
+                self._db.write(batch)
+                batch = WriteBatch()
+
+        self._db.write(batch)
+        print(f"Indexed {indexed} existing visitor states")
+
+    def get(self, user_id: str) -> VisitorState:
+        """Return the state of a visitor, the initial state if it was never seen."""
+        state = self._states.get(user_id)
+
+        if state is not None:
+            self._states.move_to_end(user_id)
+            self.hits += 1
+            return state
+
+        self.misses += 1
+        data = self._db.get(user_id)
+
+        # States stored by older versions are not packed, and start over
+        state = VisitorState.from_bytes(data) if isinstance(data, bytes) else VisitorState()
+
+        self._states[user_id] = state
+        return state
+
+    def set(self, user_id: str, state: VisitorState):
+        self._states[user_id] = state
+        self._states.move_to_end(user_id)
+        self._dirty.add(user_id)
+
+    def frame_processed(self):
+        """Count a processed frame, and write the updated states if a flush is due."""
+        self._frames += 1
+
+        if self._frames >= self.flush_frames or time.monotonic() - self._last_flush >= self.flush_seconds:
+            self.flush()
+
+        if len(self._states) > self.max_size:
+            self._evict()
+
+    def flush(self):
+        """Write every updated state to the store in a single batch, indexed under the current activity bucket."""
+        if self._dirty:
+            bucket = int(time.time() // activity_bucket_seconds)
+            batch = WriteBatch()
+
+            with self._lock:
+                for user_id in self._dirty:
+                    state = self._states[user_id]
+
+                    if state.last_active != bucket:
+                        if state.last_active:
+                            batch.delete(activity_key(state.last_active, user_id), self._index_handle)
+                        batch.put(activity_key(bucket, user_id), b"", self._index_handle)
+                        state.last_active = bucket
+
+                    batch.put(user_id, state.to_bytes())
+
+                self._db.write(batch)
+
+            self._dirty.clear()
+            self.flushes += 1
+
+        self._frames = 0
+        self._last_flush = time.monotonic()
+
+    def _evict(self):
+        # The least recently used states are first. Updated states are written before they are dropped
+        while len(self._states) > self.max_size:
+            if next(iter(self._states)) in self._dirty:
+                self.flush()
+
+            self._states.popitem(last=False)
+
+    def expire(self, batch_size: int) -> int:
+        """Delete the states of the visitors idle for more than `ttl_seconds`, `batch_size` at a time."""
+        # Every visitor indexed before this key has been idle for longer than the ttl
+        cutoff = activity_key(int((time.time() - self.ttl_seconds) // activity_bucket_seconds), "")
+        expired = 0
+
+        while True:
+            keys = []
+            for key in self._index.keys():
+                if key >= cutoff or len(keys) == batch_size:
+                    break
+                keys.append(key)
+
+            if not keys:
+                return expired
+
+            batch = WriteBatch()
+            batch_expired = 0
+
+            with self._lock:
+                for key in keys:
+                    bucket, user_id = struct.unpack(">q", key[:8])[0], key[8:].decode()
+                    batch.delete(key, self._index_handle)
+
+                    # Skip visitors that became active again since the index was read. States stored by older
+                    # versions are not packed, and are always expired
+                    data = self._db.get(user_id)
+                    if data is not None and (not isinstance(data, bytes)
+                                             or VisitorState.from_bytes(data).last_active in (0, bucket)):
+                        batch.delete(user_id)
+                        batch_expired += 1
+
+                self._db.write(batch)
+
+            expired += batch_expired
+            self.expired += batch_expired
+
+    def expire_in_thread(self, interval_seconds: float, batch_size: int) -> threading.Thread:
+        """Expire idle visitors every `interval_seconds`, in a background thread."""
+        def run():
+            while not self._closed.wait(interval_seconds):
+                try:
+                    expired = self.expire(batch_size)
+                    print(f"Expired {expired} idle visitor states. {self.store_stats()}")
+                except Exception as e:
+                    print("Error expiring visitor states:", e)
+
+        self._expiry_thread = threading.Thread(target=run, name="expire-states", daemon=True)
+        self._expiry_thread.start()
+        return self._expiry_thread
+
+    def close(self):
+        """Write the updated states and stop expiring idle visitors, so the store can be closed."""
+        self._closed.set()
+        if self._expiry_thread is not None:
+            self._expiry_thread.join()
+
+        self.flush()
+
+    def store_stats(self) -> dict:
+        """Return the estimated number of visitors in the store, which are the visitors active within the ttl, and the
+        size of the store."""
+        return {
+            "live_visitors": self._db.property_int_value("rocksdb.estimate-num-keys"),
+            "store_bytes": self._db.property_int_value("rocksdb.total-sst-files-size")
+                           + self._db.property_int_value("rocksdb.cur-size-all-mem-tables"),
+        }
+
+    def stored_state_stats(self) -> dict:
+        """Return the number of states in the store and their size, keys included. Reads the whole store."""
+        visitors = 0
+        state_bytes = 0
+
+        with self._lock:
+            for user_id, data in self._db.items():
+                visitors += 1
+                state_bytes += len(user_id.encode()) + len(data)
+
+        return {"stored_visitors": visitors, "stored_state_bytes": state_bytes}
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._states),
+            "hits": self.hits,
+            "misses": self.misses,
+            "flushes": self.flushes,
+            "expired": self.expired,
+            **self.store_stats(),
+        }
@@ -0,0 +1,89 @@
+import struct
+
+# Packed states start with the layout version. States packed by older versions start with a state code instead, lower
+# than the version, and start over
+layout_version = 0x80
+
+
+class PatternMatch:
+    """Progress of a visitor through one of the patterns.
+
+    Only what the transitions look at is kept: the state code in the combined automaton, the time and product of the
+    first click of the sequence, the product of the last click, and the number of clicks in the sequence."""
+
+    __slots__ = ("state", "first_timestamp", "first_product_id", "last_product_id", "transitions")
+
+    # State code, first timestamp, transitions and the lengths of the product ids, followed by the ids
+    _layout = struct.Struct("<HqIHH")
+
+    def __init__(self, state: int, first_timestamp: int = 0, first_product_id: str = "", last_product_id: str = "",
+                 transitions: int = 0):
+        self.state = state
+        self.first_timestamp = first_timestamp
+        self.first_product_id = first_product_id
+        self.last_product_id = last_product_id
+        self.transitions = transitions
+
+    def add_click(self, timestamp: int, product_id: str):
+        """Record a click that made the visitor change state."""
+        if self.transitions == 0:
+            self.first_timestamp = timestamp
+            self.first_product_id = product_id
+
+        self.last_product_id = product_id
+        self.transitions += 1
+
+
+class VisitorState:
+    """State of a visitor in the behaviour detector, stored in a few tens of bytes per pattern it is part way through.
+
+    `matches` has at most one `PatternMatch` per pattern, and none for the patterns the visitor is in the initial state
+    of. `automaton` identifies the patterns the state codes belong to. `last_active` is the activity bucket the visitor
+    is indexed under in the state store, for expiry."""
+
+    __slots__ = ("automaton", "matches", "last_active")
+
+    # Layout version, automaton, last activity bucket and number of matches, followed by the matches
+    _layout = struct.Struct("<BIqB")
+
+    def __init__(self, automaton: int = 0, matches: list = None, last_active: int = 0):
+        self.automaton = automaton
+        self.matches = matches if matches is not None else []
+        self.last_active = last_active
+
+    def to_bytes(self) -> bytes:
+        data = [self._layout.pack(layout_version, self.automaton, self.last_active, len(self.matches))]
+
+        for match in self.matches:
+            first_product_id = match.first_product_id.encode()
+            last_product_id = match.last_product_id.encode()
+
+            data.append(match._layout.pack(match.state, match.first_timestamp, match.transitions,
+                                           len(first_product_id), len(last_product_id)))
+            data.append(first_product_id)
+            data.append(last_product_id)
+
+        return b"".join(data)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "VisitorState":
+        if data[0] != layout_version:
+            return cls()
+
+        _, automaton, last_active, count = cls._layout.unpack_from(data)
+        offset = cls._layout.size
+        matches = []
+
+        for _ in range(count):
+            state, first_timestamp, transitions, first_length, last_length = \
+                PatternMatch._layout.unpack_from(data, offset)
+            offset += PatternMatch._layout.size
+
+            first_product_id = data[offset:offset + first_length].decode()
+            offset += first_length
+            last_product_id = data[offset:offset + last_length].decode()
+            offset += last_length
+
+            matches.append(PatternMatch(state, first_timestamp, first_product_id, last_product_id, transitions))
+
+        return cls(automaton, matches, last_active)
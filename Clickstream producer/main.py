@@ -1,145 +1,118 @@
 import os
 import quixstreams as qx
-import pandas as pd
 import time
-from datetime import datetime
 import threading
-import re
+import multiprocessing
+from replay import ClickReplay, run_worker
 
 # True = keep original timings.
 # False = No delay! Speed through it as fast as possible.
 keep_timing = "keep_timing" in os.environ and os.environ["keep_timing"] == "1"
 
-# If the process is terminated on the command line or by the container
-# setting this flag to True will tell the loops to stop and the code
-# to exit gracefully.
-shutting_down = False
-
-# Quix Platform injects credentials automatically to the client.
-# Alternatively, you can always pass an SDK token manually as an argument.
-client = qx.QuixStreamingClient()
-
-# The producer topic is where the data will be published to
-# It's the output from this demo data source code.
-print("Opening output topic")
-producer_topic = client.get_topic_producer(os.environ["output"])
-
-# counters for the status messages
-row_counter = 0
-published_total = 0
-
-
-def publish_row(row):
-    global row_counter
-    global published_total
-
-    # create a DataFrame using the row
-    df_row = pd.DataFrame([row])
-
-    # add a new timestamp column with the current data and time
-    df_row['timestamp'] = datetime.utcnow()
-
-    # publish the data to the Quix stream created earlier
-    stream_producer = producer_topic.get_or_create_stream(row['userId'])
-    stream_producer.timeseries.publish(df_row)
-
-    row_counter += 1
-
-    if row_counter == 10:
-        row_counter = 0
-        published_total += 10
-        print(f"Published {published_total} rows")
-
-
-def get_product_id(url):
-    match = re.search(r"http://www.acme.com/(\w+)/(\w+)", url)
-
-    if match is not None:
-        return match.group(2)
-
-    return url
+# Time compression for keep_timing, e.g. 60 replays an hour of the original log per minute.
+replay_speed = float(os.environ["replay_speed"]) if os.environ.get("replay_speed") else 1
 
+# Maximum number of rows published per batch. Rows due at the same time are published
+# as multi-row frames (one per visitor in the batch). Empty means no limit.
+batch_size = int(os.environ["batch_size"]) if os.environ.get("batch_size") else 0
 
-def process_csv_file(csv_file):
-    global shutting_down
+# Target publishing rate when not keeping the original timings.
+# Empty means one row every 200ms, or as fast as possible when batch_size is set.
+events_per_second = float(os.environ["events_per_second"]) if os.environ.get("events_per_second") else 0
 
-    # Read the CSV file into a pandas DataFrame
-    print("TSV file loading.")
-    df = pd.read_csv(csv_file, sep="\t")
+# Number of rows read from the TSV file at a time
+chunk_size = int(os.environ["chunk_size"]) if os.environ.get("chunk_size") else 100000
 
-    print("File loaded.")
+# Number of worker processes the replay is sharded across, by visitor id.
+workers = int(os.environ["workers"]) if os.environ.get("workers") else 1
 
-    row_count = len(df)
-    print(f"Publishing {row_count} rows.")
+# Number of copies of each visitor, each copy with its own visitor id.
+copies = int(os.environ["copies"]) if os.environ.get("copies") else 1
 
-    df = df.rename(columns={
-        "Visitor Unique ID": "userId",
-        "IP Address": "ip",
-        "29": "userAgent",  # The original file does not have name for this column
-        "Unix Timestamp": "original_timestamp",
-    })
+# Worker processes are started fresh rather than forked, they each open their own client
+context = multiprocessing.get_context("spawn")
 
-    df["userId"] = df["userId"].apply(lambda x: x.strip("{}"))
-    df["productId"] = df["Product Page URL"].apply(get_product_id)
-
-    # Get subset of columns, so it's easier to work with
-    df = df[["original_timestamp", "userId", "ip", "userAgent", "productId"]]
-
-    # Get the column headers as a list
-    headers = df.columns.tolist()
-
-    # If shutdown has been requested, exit the loop.
-    while not shutting_down:
-        # Iterate over the rows and send them to the API
-        for index, row in df.iterrows():
-
-            # If shutdown has been requested, exit the loop.
-            if shutting_down:
-                break
-
-            # Create a dictionary that includes both column headers and row values
-            row_data = {header: row[header] for header in headers}
-            publish_row(row_data)
-
-            if not keep_timing:
-                # Don't want to keep the original timing or no timestamp? That's ok, just sleep for 200ms
-                time.sleep(0.2)
-            else:
-                # Delay sending the next row if it exists
-                # The delay is calculated using the original timestamps and ensure the data
-                # is published at a rate similar to the original data rates
-                if index + 1 < len(df):
-                    current_timestamp = pd.to_datetime(row['original_timestamp'], unit='s')
-                    next_timestamp = pd.to_datetime(df.at[index + 1, 'original_timestamp'], unit='s')
-                    time_difference = next_timestamp - current_timestamp
-                    delay_seconds = time_difference.total_seconds()
-
-                    # handle < 0 delays
-                    if delay_seconds < 0:
-                        delay_seconds = 0
-
-                    if delay_seconds > 10:
-                        delay_seconds = 10
-
-                    time.sleep(delay_seconds)
-
-
-# Run the CSV processing in a thread
-processing_thread = threading.Thread(target=process_csv_file, args=('omniture-logs.tsv',))
-processing_thread.start()
+# If the process is terminated on the command line or by the container
+# setting this flag will tell the loops to stop and the code
+# to exit gracefully.
+shutting_down = context.Event()
+
+# Published rows, one counter per worker
+published_counts = context.Array("q", workers, lock=False)
+
+settings = {
+    "workers": workers,
+    "copies": copies,
+    "chunk_size": chunk_size,
+    "keep_timing": keep_timing,
+    "replay_speed": replay_speed,
+    "batch_size": batch_size,
+    "events_per_second": events_per_second,
+}
+
+
+def report_throughput():
+    last_total = 0
+    last_time = time.monotonic()
+
+    # Report every 5 seconds, batches can add up to thousands of rows per second
+    while not shutting_down.wait(5):
+        total = sum(published_counts)
+        now = time.monotonic()
+        rate = (total - last_total) / (now - last_time)
+        print(f"Published {total} rows ({rate:.0f} rows/sec)")
+        last_total = total
+        last_time = now
+
+
+def start_replay(csv_file):
+    print(f"Publishing rows in chunks of {chunk_size} rows"
+          + (f" at {replay_speed:g}x the original speed" if keep_timing else "")
+          + (f", in batches of up to {batch_size} rows" if batch_size > 0 else "")
+          + (f", with {copies} copies of each visitor" if copies > 1 else "")
+          + (f", across {workers} worker processes" if workers > 1 else "")
+          + ".")
+
+    if workers == 1:
+        # Quix Platform injects credentials automatically to the client.
+        # Alternatively, you can always pass an SDK token manually as an argument.
+        client = qx.QuixStreamingClient()
+
+        # The producer topic is where the data will be published to
+        # It's the output from this demo data source code.
+        print("Opening output topic")
+        producer_topic = client.get_topic_producer(os.environ["output"])
+
+        # Run the CSV processing in a thread
+        replay = ClickReplay(producer_topic, shutting_down, published_counts, **settings)
+        return [threading.Thread(target=replay.run, args=(csv_file,))]
+
+    # Each worker process replays the clicks of its share of the visitors
+    return [context.Process(target=run_worker, args=(csv_file, shutting_down, published_counts, worker_index),
+                            kwargs=settings)
+            for worker_index in range(workers)]
 
 
 # Run this method before shutting down.
 # In this case we set a flag to tell the loops to exit gracefully.
 def before_shutdown():
-    global shutting_down
     print("Shutting down")
 
-    # set the flag to True to stop the loops as soon as possible.
-    shutting_down = True
+    # set the flag to stop the loops as soon as possible.
+    shutting_down.set()
+
+
+if __name__ == "__main__":
+    replay_workers = start_replay('omniture-logs.tsv')
+    for replay_worker in replay_workers:
+        replay_worker.start()
+
+    threading.Thread(target=report_throughput, daemon=True).start()
 
+    # keep the app running and handle termination signals.
+    qx.App.run(before_shutdown=before_shutdown)
 
-# keep the app running and handle termination signals.
-qx.App.run(before_shutdown=before_shutdown)
+    for replay_worker in replay_workers:
+        replay_worker.join()
 
-print("Exiting.")
+    print("Exiting.")
@@ -0,0 +1,190 @@
+import os
+import signal
+import quixstreams as qx
+import pandas as pd
+import numpy as np
+import time
+from datetime import datetime
+
+# Columns read from the TSV file, everything else is skipped while parsing
+tsv_dtypes = {
+    "Unix Timestamp": "int64",
+    "Visitor Unique ID": "str",
+    "IP Address": "str",
+    "29": "str",  # The original file does not have name for this column
+    "Product Page URL": "str",
+}
+
+# Minimum time between two checks of the schedule. Rows that become due in between are sent together.
+tick_seconds = 0.01
+
+
+def get_product_ids(urls: pd.Series):
+    # Product id is the last path segment, keep the url if it does not match
+    product_ids = urls.str.extract(r"http://www.acme.com/(\w+)/(\w+)", expand=True)[1]
+    return product_ids.fillna(urls)
+
+
+def prepare_dataframe(df: pd.DataFrame):
+    df = df.rename(columns={
+        "Visitor Unique ID": "userId",
+        "IP Address": "ip",
+        "29": "userAgent",  # The original file does not have name for this column
+        "Unix Timestamp": "original_timestamp",
+    })
+
+    df["userId"] = df["userId"].str.strip("{}")
+    df["productId"] = get_product_ids(df["Product Page URL"])
+
+    # Get subset of columns, so it's easier to work with
+    return df[["original_timestamp", "userId", "ip", "userAgent", "productId"]].reset_index(drop=True)
+
+
+class ClickReplay:
+    """Replays the clicks of a TSV file to a topic, following a precomputed schedule."""
+
+    def __init__(self, producer_topic, stop_event, published_counts, worker_index: int = 0, workers: int = 1,
+                 copies: int = 1, chunk_size: int = 100000, keep_timing: bool = False, replay_speed: float = 1,
+                 batch_size: int = 0, events_per_second: float = 0):
+        self.producer_topic = producer_topic
+        self.stop_event = stop_event
+
+        # Each worker only writes its own slot, the parent process reads all of them to report throughput
+        self.published_counts = published_counts
+        self.worker_index = worker_index
+        self.workers = workers
+        self.copies = copies
+
+        self.chunk_size = chunk_size
+        self.keep_timing = keep_timing
+        self.replay_speed = replay_speed
+        self.batch_size = batch_size
+
+        # The target rate is for all workers together
+        self.events_per_second = events_per_second / workers
+
+    def publish_batch(self, df: pd.DataFrame):
+        df = df.copy()
+        df['timestamp'] = datetime.utcnow()
+
+        # One frame per visitor, so each visitor keeps its own stream
+        for user_id, user_df in df.groupby('userId', sort=False):
+            stream_producer = self.producer_topic.get_or_create_stream(user_id)
+            stream_producer.timeseries.publish(user_df)
+
+        self.published_counts[self.worker_index] += len(df)
+
+    def remap_visitors(self, df: pd.DataFrame):
+        # Every copy of a visitor gets its own id, so the number of distinct visitors is multiplied.
+        # Copies of the same click are kept next to each other, so the original timing is kept.
+        if self.copies > 1:
+            df = df.loc[df.index.repeat(self.copies)].reset_index(drop=True)
+            copy_index = np.tile(np.arange(self.copies), len(df) // self.copies)
+            suffixes = pd.Series(copy_index, dtype="str").radd("-").where(copy_index > 0, "")
+            df["userId"] = df["userId"] + suffixes.to_numpy()
+
+        # Keep only the visitors of this worker. Each visitor always goes to the same worker,
+        # so the order of its clicks is kept.
+        if self.workers > 1:
+            shards = pd.util.hash_pandas_object(df["userId"], index=False).to_numpy() % self.workers
+            df = df[shards == self.worker_index].reset_index(drop=True)
+
+        return df
+
+    def read_clicks(self, csv_file):
+        # Only parse the columns we use, and read the file in chunks so memory stays
+        # flat whatever the size of the file
+        chunks = pd.read_csv(csv_file, sep="\t", usecols=list(tsv_dtypes), dtype=tsv_dtypes,
+                             chunksize=self.chunk_size, memory_map=True)
+
+        with chunks:
+            for chunk in chunks:
+                chunk = self.remap_visitors(prepare_dataframe(chunk))
+
+                if len(chunk) > 0:
+                    yield chunk
+
+    def replay_clicks(self, csv_file):
+        # Start over from the beginning of the file when the end is reached
+        while not self.stop_event.is_set():
+            print("TSV file loading.")
+            yield from self.read_clicks(csv_file)
+
+    def get_row_interval(self):
+        # Seconds between rows when the original timings are not kept
+        if self.events_per_second:
+            return 1 / self.events_per_second
+
+        if self.batch_size > 0:
+            # No delay! Speed through it as fast as possible.
+            return 0
+
+        # Don't want to keep the original timing or no timestamp? That's ok, send a row every 200ms
+        return 0.2
+
+    def schedule_clicks(self, chunks):
+        # Compute, for every row, when it is due relative to the start of the replay.
+        # The schedule is absolute, so time spent publishing does not add up as drift.
+        row_interval = self.get_row_interval()
+        previous_timestamp = None
+        previous_due = 0.0
+
+        for chunk in chunks:
+            if self.keep_timing:
+                # The delay is calculated using the original timestamps and ensure the data
+                # is published at a rate similar to the original data rates
+                timestamps = chunk["original_timestamp"].to_numpy()
+                first = timestamps[0] if previous_timestamp is None else previous_timestamp
+                delays = np.diff(timestamps, prepend=first) / self.replay_speed
+
+                # handle < 0 delays and long gaps
+                delays = np.clip(delays, 0, 10)
+                previous_timestamp = timestamps[-1]
+            else:
+                delays = np.full(len(chunk), row_interval)
+
+            due = previous_due + np.cumsum(delays)
+            previous_due = due[-1]
+
+            yield chunk, due
+
+    def publish_scheduled(self, scheduled_chunks):
+        started = time.monotonic()
+
+        for chunk, due in scheduled_chunks:
+            position = 0
+
+            while position < len(chunk):
+                # If shutdown has been requested, exit the loop.
+                if self.stop_event.is_set():
+                    return
+
+                # Send everything due in this tick as one batch
+                elapsed = time.monotonic() - started
+                end = int(np.searchsorted(due, elapsed, side="right"))
+                if self.batch_size > 0:
+                    end = min(end, position + self.batch_size)
+
+                if end > position:
+                    self.publish_batch(chunk.iloc[position:end])
+                    position = end
+                else:
+                    # Nothing due yet, wait for the next row but keep ticks coarse enough to batch
+                    self.stop_event.wait(max(due[position] - elapsed, tick_seconds))
+
+    def run(self, csv_file):
+        self.publish_scheduled(self.schedule_clicks(self.replay_clicks(csv_file)))
+
+
+def run_worker(csv_file, stop_event, published_counts, worker_index: int, **settings):
+    # The parent process handles the termination signals and sets the stop event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Each worker process has its own client and producer
+    client = qx.QuixStreamingClient()
+    producer_topic = client.get_topic_producer(os.environ["output"])
+
+    replay = ClickReplay(producer_topic, stop_event, published_counts, worker_index=worker_index, **settings)
+    replay.run(csv_file)
+
+    producer_topic.dispose()
@@ -0,0 +1,258 @@
+"""Micro-benchmark of the enrichment stages, without a Quix workspace.
+
+Synthetic frames are built from the products and users of the Lookup data ingestion job, loaded into a local Redis
+stand-in (fakeredis, or a local Redis server with --redis-url). Every combination of frame size and cache hit ratio
+is enriched with the same code as the service, and rows/sec, p50 and p99 time per frame and the time spent in each
+stage are reported and saved as JSON, so results can be compared across commits. 1-row frames, the most common ones,
+are always benchmarked, since their time is mostly fixed costs per frame.
+
+With --baseline, the results are compared with a previous run, and the benchmark fails when a scenario has fewer
+rows/sec or a higher p50 time per frame. --save-baseline stores the results as the new baseline.
+
+    pip install fakeredis
+    python benchmark.py --frame-sizes 1,10,100,1000 --hit-ratios 0,0.5,0.9,1 --output results.json
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import redis
+
+from enricher import Enricher, get_device_type
+from ip_index import IpCountryIndex
+from lookup_cache import LookupCache
+
+lookup_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Lookup data ingestion")
+
+# Metrics compared with the baseline, and whether higher values are better
+baseline_metrics = {
+    "rows_per_second": True,
+    "p50_frame_ms": False,
+}
+
+user_agents = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148",
+    "Mozilla/5.0 (iPad; CPU OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148",
+    "Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0 Mobile Safari/537.36",
+    "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+    "Mozilla/4.0 (compatible; MSIE 8.0; Windows NT 6.1; Trident/4.0)",
+]
+
+
+def get_redis_client(redis_url: str):
+    if redis_url:
+        return redis.Redis.from_url(redis_url, decode_responses=True)
+
+    import fakeredis
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+# Load the lookup data the same way the Lookup data ingestion job does
+def load_lookup_data(redis_client: redis.Redis):
+    products = pd.read_json(os.path.join(lookup_data_dir, "products.json"))
+    users = pd.read_json(os.path.join(lookup_data_dir, "users.json"), lines=True)
+
+    pipe = redis_client.pipeline(transaction=False)
+    for product in products.itertuples():
+        pipe.hset(f"product:{product.id}", mapping={"cat": product.category, "title": product.title})
+    for user in users.dropna().itertuples():
+        pipe.hset(f"visitor:{user.userId}", mapping={"birthday": user.birthDate, "gender": user.gender})
+    pipe.execute()
+
+    return products["id"].tolist(), users["userId"].tolist()
+
+
+class FrameGenerator:
+    """Builds click frames where a given share of the products and visitors are already in the cache."""
+
+    def __init__(self, product_ids: list, visitor_ids: list, hit_ratio: float, seed: int):
+        self.product_ids = product_ids
+        self.visitor_ids = visitor_ids
+        self.hit_ratio = hit_ratio
+        self.random = random.Random(seed)
+        self.ips = [".".join(str(self.random.randint(1, 223)) for _ in range(4)) for _ in range(5000)]
+        self.unseen = 0
+
+    def pick(self, ids: list, prefix: str):
+        if self.random.random() < self.hit_ratio:
+            return self.random.choice(ids)
+
+        # Never seen before, so it is always a cache miss
+        self.unseen += 1
+        return f"{prefix}-{self.unseen}"
+
+    def frame(self, size: int) -> pd.DataFrame:
+        now = pd.Timestamp.now()
+        return pd.DataFrame({
+            "timestamp": [now] * size,
+            "original_timestamp": [int(now.timestamp())] * size,
+            "userId": [self.pick(self.visitor_ids, "visitor") for _ in range(size)],
+            "productId": [self.pick(self.product_ids, "product") for _ in range(size)],
+            "ip": [self.random.choice(self.ips) for _ in range(size)],
+            "userAgent": [self.random.choice(user_agents) for _ in range(size)],
+        })
+
+
+# Runs the same stages as Enricher.enrich_dataframe, timing each of them
+def enrich_timed(enricher: Enricher, df: pd.DataFrame, timings: dict):
+    def timed(stage, method, *args):
+        start = time.perf_counter()
+        result = method(*args)
+        timings[stage] += time.perf_counter() - start
+        return result
+
+    products, visitors = timed("lookup", enricher.get_lookup_data, df)
+    timed("category_title", enricher.add_product_data, df, products)
+    timed("birthdate", enricher.add_birthdates, df, visitors)
+    timed("country", enricher.add_countries, df)
+    timed("device_type", enricher.add_device_types, df)
+    timed("age_gender", enricher.add_ages_and_genders, df, visitors)
+
+
+def run_scenario(redis_client, ip_country_index, product_ids, visitor_ids, frame_size, hit_ratio, frames, seed):
+    lookup_cache = LookupCache(max_size=len(product_ids) + len(visitor_ids) + frames * frame_size * 2,
+                               ttl_seconds=3600)
+    enricher = Enricher(redis_client, ip_country_index, lookup_cache=lookup_cache)
+    generator = FrameGenerator(product_ids, visitor_ids, hit_ratio, seed)
+
+    # Warm the caches with every known product and visitor, then reset the counters
+    keys = [f"product:{product}" for product in product_ids] + [f"visitor:{visitor}" for visitor in visitor_ids]
+    for start in range(0, len(keys), 1000):
+        enricher.get_hashes(keys[start:start + 1000])
+    get_device_type.cache_clear()
+    enricher.enrich_dataframe(generator.frame(frame_size))
+    lookup_cache.hits = lookup_cache.misses = 0
+
+    timings = defaultdict(float)
+    frame_seconds = []
+    rows = 0
+    for _ in range(frames):
+        df = generator.frame(frame_size)
+        enriched = sum(timings.values())
+        enrich_timed(enricher, df, timings)
+        frame_seconds.append(sum(timings.values()) - enriched)
+        rows += len(df)
+
+    total = sum(timings.values())
+    lookups = lookup_cache.hits + lookup_cache.misses
+    return {
+        "frame_size": frame_size,
+        "hit_ratio": hit_ratio,
+        "measured_hit_ratio": lookup_cache.hits / lookups if lookups else None,
+        "frames": frames,
+        "rows": rows,
+        "seconds": total,
+        "rows_per_second": rows / total,
+        "p50_frame_ms": float(np.percentile(frame_seconds, 50)) * 1000,
+        "p99_frame_ms": float(np.percentile(frame_seconds, 99)) * 1000,
+        "stage_seconds": dict(timings),
+    }
+
+
+# Method to list the scenarios that regressed past the tolerance, compared with the baseline
+def compare_with_baseline(results: list, baseline: list, tolerance: float) -> list:
+    baseline = {(result["frame_size"], result["hit_ratio"]): result for result in baseline}
+    regressions = []
+
+    for result in results:
+        previous = baseline.get((result["frame_size"], result["hit_ratio"]))
+        if previous is None:
+            continue
+
+        for metric, higher_is_better in baseline_metrics.items():
+            value, limit = result[metric], previous[metric]
+            if (value < limit * (1 - tolerance)) if higher_is_better else (value > limit * (1 + tolerance)):
+                regressions.append(f"frame size {result['frame_size']}, hit ratio {result['hit_ratio']:.2f}: "
+                                   f"{metric} {value:.2f}, baseline {limit:.2f}")
+
+    return regressions
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the enrichment stages against synthetic frames")
+    parser.add_argument("--frame-sizes", default="1,10,100,1000", help="Comma separated rows per frame")
+    parser.add_argument("--hit-ratios", default="0,0.5,0.9,1", help="Comma separated lookup cache hit ratios")
+    parser.add_argument("--frames", type=int, default=200, help="Frames enriched per scenario")
+    parser.add_argument("--redis-url", help="Local Redis server to use instead of fakeredis")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file the results are saved to")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare the results with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative change allowed from the baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the baseline")
+    args = parser.parse_args()
+
+    # 1-row frames are always benchmarked
+    frame_sizes = [int(size) for size in args.frame_sizes.split(",")]
+    if 1 not in frame_sizes:
+        frame_sizes.insert(0, 1)
+
+    redis_client = get_redis_client(args.redis_url)
+
+    print("Loading lookup data")
+    product_ids, visitor_ids = load_lookup_data(redis_client)
+
+    print("Loading IP to country index")
+    ip_country_index = IpCountryIndex.from_iptocc()
+
+    results = []
+    for hit_ratio in [float(ratio) for ratio in args.hit_ratios.split(",")]:
+        for frame_size in frame_sizes:
+            result = run_scenario(redis_client, ip_country_index, product_ids, visitor_ids,
+                                  frame_size, hit_ratio, args.frames, args.seed)
+            results.append(result)
+
+            stages = ", ".join(f"{stage} {seconds / result['seconds']:.0%}"
+                               for stage, seconds in result["stage_seconds"].items())
+            print(f"frame size {frame_size:>5}, hit ratio {hit_ratio:.2f}: "
+                  f"{result['rows_per_second']:>10.0f} rows/sec, p50 {result['p50_frame_ms']:.2f} ms, "
+                  f"p99 {result['p99_frame_ms']:.2f} ms per frame ({stages})")
+
+    output = {
+        "commit": get_commit(),
+        "date": datetime.utcnow().isoformat(),
+        "redis": args.redis_url or "fakeredis",
+        "results": results,
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(output, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+
+    elif args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f)["results"], args.tolerance)
+
+        if regressions:
+            print("Regressions from the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+
+        print("No regressions from the baseline")
+
+
+if __name__ == "__main__":
+    main()
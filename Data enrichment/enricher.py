@@ -0,0 +1,189 @@
+import os
+from datetime import date
+from functools import lru_cache
+
+import pandas as pd
+import redis
+from user_agents_next import parse
+
+from ip_index import IpCountryIndex
+from lookup_cache import LookupCache, get_key_prefix
+from lookup_replica import LookupReplica
+from packed_records import PackedRecordReader
+
+# Maximum number of distinct user agents whose device type is memoized
+user_agent_cache_size = int(os.environ['user_agent_cache_size']) if os.environ.get('user_agent_cache_size') else 10000
+
+# Frames up to this many rows have their ages computed row by row, which avoids the fixed cost of the pandas datetime
+# conversions. Most frames have a single row
+small_frame_rows = 16
+
+# Fields read from each kind of Redis hash
+lookup_fields = {'product': ['cat', 'title'], 'visitor': ['birthday', 'gender']}
+
+
+# Method to calculate the age of a visitor, None when the birthdate is unknown
+def calculate_age(birthdate: str, current_date: pd.Timestamp):
+    try:
+        birthdate = date.fromisoformat(birthdate)
+    except (TypeError, ValueError):
+        return None
+
+    # One year less if the birthday for this year has not occurred yet
+    birthday_not_reached = (birthdate.month, birthdate.day) > (current_date.month, current_date.day)
+    return current_date.year - birthdate.year - birthday_not_reached
+
+
+# Method to calculate the age of the visitors of a frame, against a single current date
+def calculate_ages(birthdates: pd.Series, current_date: pd.Timestamp) -> pd.Series:
+    if len(birthdates) <= small_frame_rows:
+        ages = [calculate_age(birthdate, current_date) for birthdate in birthdates]
+
+        # Keep integer ages when every birthdate is known
+        return pd.Series(ages, index=birthdates.index, dtype='float64' if None in ages else 'int64')
+
+    birthdates = pd.to_datetime(birthdates, format='%Y-%m-%d', errors='coerce')
+
+    # Calculate the age
+    ages = current_date.year - birthdates.dt.year
+
+    # Check if the birthday for this year has already occurred
+    birthday_not_reached = ((birthdates.dt.month > current_date.month)
+                            | ((birthdates.dt.month == current_date.month) & (birthdates.dt.day > current_date.day)))
+    ages = ages - birthday_not_reached.astype('int64')
+
+    # Keep integer ages when every birthdate is known
+    return ages if ages.isna().any() else ages.astype('int64')
+
+
+# Parsing user agents is expensive, but real traffic only has a few thousand distinct ones.
+# Results are memoized, including "Unknown" for user agents that fail to parse
+@lru_cache(maxsize=user_agent_cache_size)
+def get_device_type(user_agent: str):
+    try:
+        ua = parse(user_agent)
+        if ua.is_mobile:
+            return "Mobile"
+        elif ua.is_tablet:
+            return "Tablet"
+        elif ua.is_pc:
+            return "Desktop"
+        elif ua.is_bot:
+            return "Bot"
+        else:
+            return "Other"
+    except Exception as e:
+        print(f"Error parsing user agent {user_agent}: {e}")
+
+    return "Unknown"
+
+
+class Enricher:
+    """Enriches click frames with product, visitor, country and device data.
+
+    Product and visitor data is read from the local replica when there is one, otherwise from the cache,
+    and only from Redis for the keys that are in neither. With a packed record reader, those keys are read
+    from their packed records instead of their hashes."""
+
+    def __init__(self, redis_client: redis.Redis, ip_country_index: IpCountryIndex,
+                 lookup_cache: LookupCache = None, lookup_replica: LookupReplica = None,
+                 packed_records: PackedRecordReader = None):
+        self.redis_client = redis_client
+        self.ip_country_index = ip_country_index
+        self.lookup_cache = lookup_cache
+        self.lookup_replica = lookup_replica
+        self.packed_records = packed_records
+
+    # Method to get the data of the given Redis hashes, from the local replica, the cache or Redis.
+    # All the cache misses are read in a single pipeline, so each frame costs at most one round trip whatever its size
+    def get_hashes(self, keys: list) -> dict:
+        if self.lookup_replica is not None:
+            return self.lookup_replica.get_many(keys, lookup_fields)
+
+        if self.lookup_cache is not None:
+            generation = self.lookup_cache.generation
+            key_prefix = self.lookup_cache.key_prefix
+            values = self.lookup_cache.get_many(keys)
+        else:
+            key_prefix = get_key_prefix(self.redis_client)
+            values = {}
+
+        missing = [key for key in keys if key not in values]
+
+        if missing:
+            if self.packed_records is not None:
+                fetched = self.packed_records.get_many(missing, key_prefix)
+            else:
+                pipe = self.redis_client.pipeline(transaction=False)
+
+                for key in missing:
+                    pipe.hmget(key_prefix + key, *lookup_fields[key.split(':', 1)[0]])
+
+                fetched = dict(zip(missing, pipe.execute()))
+
+            if self.lookup_cache is not None:
+                self.lookup_cache.set_many(fetched, generation)
+            values.update(fetched)
+
+        return values
+
+    # Method to get the product and visitor data for the distinct products and visitors of a frame
+    def get_lookup_data(self, df: pd.DataFrame):
+        product_ids = df['productId'].unique()
+        visitor_ids = df['userId'].unique()
+
+        product_keys = [f'product:{product}' for product in product_ids]
+        visitor_keys = [f'visitor:{visitor}' for visitor in visitor_ids]
+        values = self.get_hashes(product_keys + visitor_keys)
+
+        products = pd.DataFrame([values[key] for key in product_keys], index=product_ids,
+                                columns=['category', 'title'])
+        visitors = pd.DataFrame([values[key] for key in visitor_keys], index=visitor_ids,
+                                columns=['birthdate', 'gender'])
+        return products, visitors
+
+    def add_product_data(self, df: pd.DataFrame, products: pd.DataFrame):
+        df['category'] = df['productId'].map(products['category']).fillna("Unknown")
+        df['title'] = df['productId'].map(products['title']).fillna("Unknown")
+
+    def add_birthdates(self, df: pd.DataFrame, visitors: pd.DataFrame):
+        df['birthdate'] = df['userId'].map(visitors['birthdate'])
+
+    def add_countries(self, df: pd.DataFrame):
+        df['country'] = self.ip_country_index.lookup(df['ip'])
+
+    def add_device_types(self, df: pd.DataFrame):
+        df['deviceType'] = df['userAgent'].map({ua: get_device_type(ua) for ua in df['userAgent'].unique()})
+
+    def add_ages_and_genders(self, df: pd.DataFrame, visitors: pd.DataFrame):
+        # For synthetic data (from csv) we don't have age. For data generated form our live web, we have age and gender
+        if 'age' not in df.columns:
+            df['age'] = calculate_ages(df['birthdate'], pd.Timestamp.now())
+        else:
+            df['age'] = pd.to_numeric(df['age']).astype('int64')
+
+        if 'gender' not in df.columns:
+            df['gender'] = df['userId'].map(visitors['gender']).fillna("U")
+        else:
+            df['gender'] = df['gender'].str[0]
+
+    # Method to enrich a frame with the product, visitor, country and device data
+    def enrich_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        # Look up every distinct product and visitor of the frame at once
+        products, visitors = self.get_lookup_data(df)
+
+        # Enrich data
+        self.add_product_data(df, products)
+        self.add_birthdates(df, visitors)
+        self.add_countries(df)
+        self.add_device_types(df)
+        self.add_ages_and_genders(df, visitors)
+
+        return df
+
+    def stats(self) -> dict:
+        lookups = self.lookup_replica or self.lookup_cache
+        return {
+            "lookups": lookups.stats() if lookups is not None else {},
+            "user_agents": get_device_type.cache_info()._asdict(),
+        }
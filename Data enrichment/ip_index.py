@@ -0,0 +1,117 @@
+import glob
+import ipaddress
+import os
+from importlib.util import find_spec
+
+import numpy as np
+import pandas as pd
+import pycountry
+
+rir_columns = ["registry", "country_code", "type", "start", "value", "date", "status", "extensions"]
+
+
+def ipv4_to_int(ips: pd.Series) -> np.ndarray:
+    """Convert IPv4 addresses to integers, -1 for anything that is not an IPv4 address."""
+    octets = ips.astype("str").str.extract(r"^(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})$").astype("float64")
+    valid = (octets <= 255).all(axis=1).to_numpy()
+    addresses = octets.fillna(0).to_numpy().astype("int64") @ np.array([1 << 24, 1 << 16, 1 << 8, 1])
+    return np.where(valid, addresses, -1)
+
+
+def ipv6_to_int(ip: str) -> int:
+    """Return the first 64 bits of an IPv6 address, -1 for anything that is not an IPv6 address. RIRs never delegate
+    IPv6 ranges smaller than a /64, so the rest of the address never changes its country."""
+    try:
+        return int(ipaddress.IPv6Address(ip)) >> 64
+    except ValueError:
+        return -1
+
+
+class IpCountryIndex:
+    """IP address to country name index, built once from the RIR delegation files shipped with IPToCC.
+
+    Ranges are kept as sorted numpy arrays, one set for IPv4 and one for the first 64 bits of IPv6 addresses, so a
+    whole column of addresses is resolved with one `searchsorted` per address family."""
+
+    def __init__(self, starts: np.ndarray, ends: np.ndarray, country_indices: np.ndarray, country_names: np.ndarray,
+                 ipv6_starts: np.ndarray, ipv6_ends: np.ndarray, ipv6_country_indices: np.ndarray):
+        self.starts = starts
+        self.ends = ends
+        self.country_indices = country_indices
+
+        self.ipv6_starts = ipv6_starts
+        self.ipv6_ends = ipv6_ends
+        self.ipv6_country_indices = ipv6_country_indices
+
+        # The last name is used for addresses outside every range
+        self.country_names = np.append(country_names, "Unknown")
+
+    @classmethod
+    def from_iptocc(cls):
+        # Locate the package without importing it, the files are all we need
+        iptocc_dir = find_spec("iptocc").submodule_search_locations[0]
+        rir_files = glob.glob(os.path.join(iptocc_dir, "delegated-*-extended-latest"))
+
+        if not rir_files:
+            raise FileNotFoundError(f"No RIR delegation files found in {iptocc_dir}")
+
+        ranges = pd.concat(pd.read_csv(rir_file, delimiter="|", comment="#", names=rir_columns, dtype="str",
+                                       keep_default_na=False, na_values=[""])
+                           for rir_file in rir_files)
+
+        # Keep the delegated IP ranges, skipping summary lines and reserved or available ranges
+        ranges = ranges[ranges["type"].isin(["ipv4", "ipv6"]) & ranges["country_code"].notna()
+                        & (ranges["start"] != "*")]
+        country_codes = pd.Categorical(ranges["country_code"])
+
+        # IPv4 ranges have a number of addresses, IPv6 ranges a prefix length
+        ipv4 = (ranges["type"] == "ipv4").to_numpy()
+        starts = ipv4_to_int(ranges["start"][ipv4])
+        ends = starts + ranges["value"][ipv4].astype("int64").to_numpy()
+
+        ipv6 = ~ipv4
+        ipv6_starts = np.array([ipv6_to_int(ip) for ip in ranges["start"][ipv6]], dtype="uint64")
+        ipv6_ends = ipv6_starts + (np.uint64(1) << (64 - ranges["value"][ipv6].astype("uint64").to_numpy()))
+
+        order = np.argsort(starts, kind="stable")
+        ipv6_order = np.argsort(ipv6_starts, kind="stable")
+
+        # Country names are resolved once per country code, not once per address
+        country_names = np.array([getattr(pycountry.countries.get(alpha_2=code), "name", "Unknown")
+                                  for code in country_codes.categories], dtype=object)
+
+        return cls(starts[order], ends[order], country_codes.codes[ipv4][order].astype("int16"), country_names,
+                   ipv6_starts[ipv6_order], ipv6_ends[ipv6_order],
+                   country_codes.codes[ipv6][ipv6_order].astype("int16"))
+
+    # Method to find the country name index of every address in sorted ranges, the "Unknown" index when it is not in
+    # any range. Negative IPv4 addresses are never in a range
+    def find(self, addresses: np.ndarray, starts: np.ndarray, ends: np.ndarray, country_indices: np.ndarray):
+        positions = np.searchsorted(starts, addresses, side="right") - 1
+        positions = np.maximum(positions, 0)
+        found = (addresses >= 0) & (addresses >= starts[positions]) & (addresses < ends[positions])
+
+        return np.where(found, country_indices[positions], len(self.country_names) - 1)
+
+    def lookup(self, ips: pd.Series) -> pd.Series:
+        """Return the country name of every address, "Unknown" when it is not in any range."""
+        addresses = ipv4_to_int(ips)
+        name_indices = self.find(addresses, self.starts, self.ends, self.country_indices)
+
+        # Other addresses are parsed as IPv6, once per distinct address
+        others = addresses < 0
+        if others.any():
+            other_ips = ips[others].astype("str")
+            distinct_ips = other_ips.unique()
+            ipv6_addresses = [ipv6_to_int(ip) for ip in distinct_ips]
+
+            # Addresses that are not IPv6 are unknown
+            valid = np.array([address >= 0 for address in ipv6_addresses], dtype=bool)
+            ipv6_name_indices = np.full(len(distinct_ips), len(self.country_names) - 1)
+            ipv6_name_indices[valid] = self.find(
+                np.array([address for address in ipv6_addresses if address >= 0], dtype="uint64"),
+                self.ipv6_starts, self.ipv6_ends, self.ipv6_country_indices)
+
+            name_indices[others] = pd.Series(ipv6_name_indices, index=distinct_ips)[other_ips].to_numpy()
+
+        return pd.Series(self.country_names[name_indices], index=ips.index)
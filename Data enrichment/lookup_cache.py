@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import OrderedDict
+import redis
+
+# Channel the Lookup data ingestion job announces updated keys on
+lookup_updates_channel = "lookup_updates"
+
+# Key holding the current version when the Lookup data ingestion job loads versioned namespaces
+lookup_version_key = "lookup_version"
+
+
+# Method to get the prefix of the keys of the current version, empty when the data is not versioned
+def get_key_prefix(redis_client) -> str:
+    version = redis_client.get(lookup_version_key)
+    return f"v{version}:" if version else ""
+
+
+class LookupCache:
+    """Bounded in-process cache of Redis hashes, evicted by LRU and TTL.
+
+    Keys starting with one of `ttl_exempt_prefixes` never expire, and are only evicted by LRU and invalidations."""
+
+    def __init__(self, max_size: int, ttl_seconds: float, ttl_exempt_prefixes: tuple = ()):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.ttl_exempt_prefixes = tuple(ttl_exempt_prefixes)
+
+        # key -> (expiry time, values). Most recently used keys are at the end
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Prefix of the Redis keys holding the cached data, for the current version of the lookup data
+        self.key_prefix = ""
+
+        # Incremented on every invalidation, so values read from Redis before an invalidation are not cached
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_many(self, keys) -> dict:
+        """Return the cached values of the given keys. Missing and expired keys are left out."""
+        found = {}
+        now = time.monotonic()
+
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+
+                if entry is None:
+                    continue
+
+                if entry[0] < now:
+                    del self._entries[key]
+                    self.evictions += 1
+                    continue
+
+                self._entries.move_to_end(key)
+                found[key] = entry[1]
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        return found
+
+    def set_many(self, values: dict, generation: int):
+        """Cache values read from Redis, unless keys were invalidated since `generation`."""
+        expiry = time.monotonic() + self.ttl_seconds
+
+        with self._lock:
+            if generation != self.generation:
+                return
+
+            for key, value in values.items():
+                self._entries[key] = (float("inf") if key.startswith(self.ttl_exempt_prefixes) else expiry, value)
+                self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: str):
+        """Remove a key from the cache. Keys ending with `*` remove every key with that prefix."""
+        with self._lock:
+            self.generation += 1
+
+            if key.endswith("*"):
+                prefix = key[:-1]
+                for cached_key in [k for k in self._entries if k.startswith(prefix)]:
+                    del self._entries[cached_key]
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def listen_for_invalidations(self, redis_client, keyspace_notifications: bool = False):
+        """Invalidate keys announced on the lookup updates channel, and optionally on keyspace notifications.
+
+        Keyspace notifications need `notify-keyspace-events` to be enabled on the Redis server. Announcements missed
+        while Redis is unreachable are caught up by invalidating everything once it is back."""
+        self.key_prefix = get_key_prefix(redis_client)
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+
+        # Each message holds one key (or key prefix ending with `*`) per line
+        def on_lookup_update(message):
+            for key in message["data"].splitlines():
+                # Everything is invalidated when a new version is switched to, so read the new prefix first
+                if key == "*":
+                    self.key_prefix = get_key_prefix(redis_client)
+                self.invalidate(key)
+
+        pubsub.subscribe(**{lookup_updates_channel: on_lookup_update})
+
+        if keyspace_notifications:
+            def on_keyspace_event(message):
+                self.invalidate(message["channel"].split(":", 1)[1])
+
+            pubsub.psubscribe(**{"__keyspace@*__:product:*": on_keyspace_event,
+                                 "__keyspace@*__:visitor:*": on_keyspace_event})
+
+        def listen():
+            resync = False
+
+            while True:
+                try:
+                    if resync:
+                        self.key_prefix = get_key_prefix(redis_client)
+                        self.invalidate("*")
+                        resync = False
+
+                    pubsub.get_message(timeout=1)
+                except (redis.ConnectionError, redis.TimeoutError) as e:
+                    print("Lookup cache lost its connection to Redis, serving cached data:", e)
+                    resync = True
+                    time.sleep(1)
+
+        thread = threading.Thread(target=listen, daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,185 @@
+import os
+import threading
+import time
+import redis
+from rocksdict import Rdict, WriteBatch
+from lookup_cache import get_key_prefix, lookup_updates_channel
+
+# Hashes replicated from Redis
+replicated_prefixes = ["product:", "visitor:"]
+
+# Field added to every replicated hash, holding the generation of the load that last wrote it
+generation_field = "__replica_generation"
+
+
+class LookupReplica:
+    """Local replica of the product and visitor hashes, kept in a RocksDB store.
+
+    The replica is loaded in bulk at startup and then kept up to date from the keys announced by the
+    Lookup data ingestion job, so lookups never go to Redis. When a new version of the lookup data is switched to,
+    or after an outage, it is loaded into a second store, which replaces the first one once complete."""
+
+    def __init__(self, redis_client: redis.Redis, path: str, batch_size: int = 1000):
+        self.redis_client = redis_client
+        self.batch_size = batch_size
+
+        # make sure the state dir exists
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Reloads alternate between the two paths, the store being loaded never being the one read from
+        self._paths = [path, path + ".next"]
+        self._db = Rdict(path)
+        self._lock = threading.Lock()
+
+        # Prefix of the Redis keys of the current version of the lookup data. Keys are stored without it
+        self.key_prefix = get_key_prefix(redis_client)
+
+        # Every load writes the keys it finds with a new generation, so the keys left with an older one were removed
+        self.generation = time.time_ns()
+
+        self.keys_loaded = 0
+        self.updates_applied = 0
+
+    def get_many(self, keys: list, fields: dict) -> dict:
+        """Return the requested fields of every key, None for missing keys and fields."""
+        with self._lock:
+            hashes = self._db.get(keys)
+
+        return {key: [(values or {}).get(field) for field in fields[key.split(":", 1)[0]]]
+                for key, values in zip(keys, hashes)}
+
+    def _write(self, db: Rdict, keys: list):
+        # Read the hashes from Redis in one round trip, and write them in one batch
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(self.key_prefix + key)
+
+        batch = WriteBatch()
+        for key, values in zip(keys, pipe.execute()):
+            if values:
+                values[generation_field] = self.generation
+                batch.put(key, values)
+            else:
+                batch.delete(key)
+
+        db.write(batch)
+
+    def load(self, prefix: str, db: Rdict = None):
+        """Replicate every hash whose key starts with `prefix` into `db`, the store read from by default, removing the
+        ones no longer in Redis.
+
+        The keys found are written with a new generation, then the keys still holding an older one are removed, so
+        memory does not grow with the number of keys."""
+        db = self._db if db is None else db
+        started = time.monotonic()
+        self.generation = max(time.time_ns(), self.generation + 1)
+        loaded = 0
+        keys = []
+
+        for key in self.redis_client.scan_iter(match=f"{self.key_prefix}{prefix}*", count=self.batch_size):
+            keys.append(key[len(self.key_prefix):])
+
+            if len(keys) == self.batch_size:
+                self._write(db, keys)
+                loaded += len(keys)
+                keys = []
+
+        if keys:
+            self._write(db, keys)
+            loaded += len(keys)
+
+        removed = WriteBatch()
+        for key, values in db.items(from_key=prefix):
+            if not key.startswith(prefix):
+                break
+            if values.get(generation_field) != self.generation:
+                removed.delete(key)
+
+            if len(removed) == self.batch_size:
+                db.write(removed)
+                removed = WriteBatch()
+        db.write(removed)
+
+        self.keys_loaded += loaded
+        print(f"Replicated {loaded} {prefix}* keys in {time.monotonic() - started:.1f} seconds")
+
+    def load_all(self, db: Rdict = None):
+        for prefix in replicated_prefixes:
+            self.load(prefix, db)
+
+    def reload(self):
+        """Load the current version of every hash into a new store, and read from it once it is complete, so lookups
+        never see a mix of two versions."""
+        self.key_prefix = get_key_prefix(self.redis_client)
+
+        path = self._paths[1]
+        Rdict.destroy(path)
+        db = Rdict(path)
+
+        try:
+            self.load_all(db)
+        except Exception:
+            db.close()
+            raise
+
+        with self._lock:
+            previous, self._db = self._db, db
+
+        previous.close()
+        self._paths.reverse()
+
+    def apply_update(self, key: str):
+        """Apply a key announced as updated. Keys ending with `*` reload every key with that prefix,
+        and `*` alone reloads everything from the current version."""
+        if key == "*":
+            self.reload()
+        elif key.endswith("*"):
+            self.load(key[:-1])
+        elif any(key.startswith(prefix) for prefix in replicated_prefixes):
+            self._write(self._db, [key])
+
+        self.updates_applied += 1
+
+    def stats(self) -> dict:
+        return {
+            "keys_loaded": self.keys_loaded,
+            "updates_applied": self.updates_applied,
+        }
+
+    def listen_for_updates(self, keyspace_notifications: bool = False):
+        """Apply the keys announced on the lookup updates channel, and optionally on keyspace notifications.
+
+        Updates missed while Redis is unreachable are caught up with a full reload once it is back."""
+        pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+
+        # Each message holds one key (or key prefix ending with `*`) per line
+        def on_lookup_update(message):
+            for key in message["data"].splitlines():
+                self.apply_update(key)
+
+        pubsub.subscribe(**{lookup_updates_channel: on_lookup_update})
+
+        if keyspace_notifications:
+            def on_keyspace_event(message):
+                self.apply_update(message["channel"].split(":", 1)[1])
+
+            pubsub.psubscribe(**{f"__keyspace@*__:{prefix}*": on_keyspace_event for prefix in replicated_prefixes})
+
+        def listen():
+            resync = False
+
+            while True:
+                try:
+                    if resync:
+                        self.reload()
+                        resync = False
+
+                    pubsub.get_message(timeout=1)
+                except (redis.ConnectionError, redis.TimeoutError) as e:
+                    print("Lookup replica lost its connection to Redis, serving local data:", e)
+                    resync = True
+                    time.sleep(1)
+
+        thread = threading.Thread(target=listen, daemon=True)
+        thread.start()
+        return thread
@@ -1,11 +1,14 @@
-import pycountry
 import quixstreams as qx
-from datetime import datetime
 import pandas as pd
 import os
 import redis
-from iptocc import get_country_code
-from user_agents_next import parse
+from enricher import Enricher
+from lookup_cache import LookupCache
+from lookup_replica import LookupReplica
+from packed_records import PackedRecordReader
+from ip_index import IpCountryIndex
+from pipeline import EnrichmentPipeline
+from stream_pool import StreamPool
 
 # Quix injects credentials automatically to the client.
 # Alternatively, you can always pass an SDK token manually as an argument.
@@ -15,6 +18,12 @@ print("Opening input and output topics")
 consumer_topic = client.get_topic_consumer(os.environ["input"], "default-consumer-group")
 producer_topic = client.get_topic_producer(os.environ["output"])
 
+# Output streams are kept open while their visitor is active, and closed when idle or when the pool is full
+stream_pool = StreamPool(
+    producer_topic,
+    max_size=int(os.environ['stream_pool_size']) if os.environ.get('stream_pool_size') else 10000,
+    idle_seconds=float(os.environ['stream_idle_seconds']) if os.environ.get('stream_idle_seconds') else 1800)
+
 redis_client = redis.Redis(
     host=os.environ['redis_host'],
     port=int(os.environ['redis_port']),
@@ -22,118 +31,63 @@ redis_client = redis.Redis(
     username=os.environ.get('redis_username'),
     decode_responses=True)
 
-
-# Method to calculate the age of a visitor
-def calculate_age(birthdate: str):
-    if birthdate is None:
-        return None
-
-    # Convert the birthdate string to a datetime object
-    birthdate = datetime.strptime(birthdate, '%Y-%m-%d')
-
-    # Get the current date
-    current_date = datetime.now()
-
-    # Calculate the age
-    age = current_date.year - birthdate.year
-
-    # Check if the birthday for this year has already occurred
-    if (current_date.month, current_date.day) < (birthdate.month, birthdate.day):
-        age -= 1
-
-    return age
-
-
-# Method to get the product category for a product from Redis
-def get_product_category(product: str):
-    return redis_client.hget(f'product:{product}', 'cat') or "Unknown"
-
-
-# Method to get the product title for a product from Redis
-def get_product_title(product: str):
-    return redis_client.hget(f'product:{product}', 'title') or "Unknown"
-
-
-# Method to get the visitor gender from Redis
-def get_visitor_gender(visitor: str):
-    return redis_client.hget(f'visitor:{visitor}', 'gender') or "U"
-
-
-# Method to get the visitor birthdate from Redis
-def get_visitor_birthdate(visitor: str):
-    return redis_client.hget(f'visitor:{visitor}', 'birthday')
-
-
-# Method to get the visitor age
-def get_visitor_age(visitor: str):
-    birthday = redis_client.hget(f'visitor:{visitor}', 'birthday')
-    return calculate_age(birthday)
-
-
-def get_country_from_ip(ip: str):
-    try:
-        country_code = get_country_code(ip)
-        country = pycountry.countries.get(alpha_2=country_code)
-        return country.name
-    except Exception as e:
-        print(f"Error looking up country for IP {ip}:", e)
-
-    return "Unknown"
-
-
-def get_device_type(user_agent: str):
-    try:
-        ua = parse(user_agent)
-        if ua.is_mobile:
-            return "Mobile"
-        elif ua.is_tablet:
-            return "Tablet"
-        elif ua.is_pc:
-            return "Desktop"
-        elif ua.is_bot:
-            return "Bot"
-        else:
-            return "Other"
-    except Exception as e:
-        print(f"Error parsing user agent {user_agent}: {e}")
-
-    return "Unknown"
-
-
-def get_first_letter_of_gender(gender):
-    return gender[0]
-
-
-def convert_age_to_int(age):
-    return int(age)
+keyspace_notifications = os.environ.get('keyspace_notifications') == '1'
+
+if os.environ.get('lookup_replica') == '1':
+    # All the product and visitor data is replicated locally, so lookups never go to Redis.
+    # The Lookup data ingestion job announces the keys it updates, so they are replicated right away
+    print("Loading lookup replica")
+    lookup_replica = LookupReplica(redis_client, "state/lookup_replica.dict")
+    lookup_replica.load_all()
+    lookup_replica.listen_for_updates(keyspace_notifications=keyspace_notifications)
+    lookup_cache = None
+else:
+    # Product and visitor data rarely changes, so it is cached in the process and only read from Redis on a miss.
+    # The Lookup data ingestion job announces the keys it updates, so they are evicted from the cache right away.
+    # Products are only changed by that job, so they do not expire, and the most clicked ones are never read again
+    lookup_replica = None
+    lookup_cache = LookupCache(
+        max_size=int(os.environ['cache_size']) if os.environ.get('cache_size') else 100000,
+        ttl_seconds=float(os.environ['cache_ttl_seconds']) if os.environ.get('cache_ttl_seconds') else 600,
+        ttl_exempt_prefixes=("product:",))
+    lookup_cache.listen_for_invalidations(redis_client, keyspace_notifications=keyspace_notifications)
+
+# IPv4 ranges are loaded once, so the country of a whole frame is resolved with one vectorized lookup
+print("Loading IP to country index")
+ip_country_index = IpCountryIndex.from_iptocc()
+
+# With packed_records set to '1', products and visitors missing from the cache are read from the packed records the
+# Lookup data ingestion job writes, with one MGET per frame, instead of their hashes
+packed_records = PackedRecordReader(redis_client) if os.environ.get('packed_records') == '1' else None
+
+enricher = Enricher(redis_client, ip_country_index, lookup_cache=lookup_cache, lookup_replica=lookup_replica,
+                    packed_records=packed_records)
+
+frames_received = 0
+
+
+# Method to publish an enriched frame to the output stream of its visitor
+def publish_dataframe(stream_id: str, df: pd.DataFrame):
+    # Create a new stream (or reuse it if it was already created).
+    # We will be using one stream per visitor id, so we can parallelise the processing
+    # because the partitioning key will be the stream id
+    producer_stream = stream_pool.get_stream(stream_id, parent_id=stream_id)
+    producer_stream.timeseries.buffer.publish(df)
 
 
 # Callback triggered for each new timeseries data. This method will enrich the data
 def on_dataframe_handler(stream_consumer: qx.StreamConsumer, df: pd.DataFrame):
-    # Enrich data
-    df['category'] = df['productId'].apply(get_product_category)
-    df['title'] = df['productId'].apply(get_product_title)
-    df['birthdate'] = df['userId'].apply(get_visitor_birthdate)
-    df['country'] = df['ip'].apply(get_country_from_ip)
-    df['deviceType'] = df['userAgent'].apply(get_device_type)
-
-    # For synthetic data (from csv) we don't have age. For data generated form our live web, we have age and gender
-    if 'age' not in df.columns:
-        df['age'] = df['birthdate'].apply(calculate_age)
-    else:
-        df['age'] = df['age'].apply(convert_age_to_int)
-
-    if 'gender' not in df.columns:
-        df['gender'] = df['userId'].apply(get_visitor_gender)
+    global frames_received
+    frames_received += 1
+    if frames_received % 1000 == 0:
+        queue_depth = enrichment_pipeline.queue_depth() if enrichment_pipeline is not None else 0
+        print(f"Received {frames_received} frames. {enricher.stats()}. Frames in flight: {queue_depth}. "
+              f"Output streams: {stream_pool.size()} open, {stream_pool.closed} closed")
+
+    if enrichment_pipeline is not None:
+        enrichment_pipeline.submit(stream_consumer.stream_id, df)
     else:
-        df['gender'] = df['gender'].apply(get_first_letter_of_gender)
-
-    # Create a new stream (or reuse it if it was already created).
-    # We will be using one stream per visitor id, so we can parallelise the processing
-    # because the partitioning key will be the stream id
-    producer_stream = producer_topic.get_or_create_stream(stream_consumer.stream_id)
-    producer_stream.properties.parents.append(stream_consumer.stream_id)
-    producer_stream.timeseries.buffer.publish(df)
+        publish_dataframe(stream_consumer.stream_id, enricher.enrich_dataframe(df))
 
 
 # Callback called for each incoming stream
@@ -142,11 +96,31 @@ def read_stream(consumer_stream: qx.StreamConsumer):
     consumer_stream.timeseries.on_dataframe_received = on_dataframe_handler
 
 
+# With pipeline_workers set, frames are enriched in a pool of threads so the Redis round trips of many frames overlap,
+# and published in the order they were received. Otherwise frames are enriched in the consumer callback
+pipeline_workers = int(os.environ['pipeline_workers']) if os.environ.get('pipeline_workers') else 0
+
+if pipeline_workers > 0:
+    enrichment_pipeline = EnrichmentPipeline(
+        enricher.enrich_dataframe, publish_dataframe, workers=pipeline_workers,
+        queue_size=int(os.environ['pipeline_queue_size']) if os.environ.get('pipeline_queue_size') else 100)
+else:
+    enrichment_pipeline = None
+
 # Hook up events before initiating read to avoid losing out on any data
 consumer_topic.on_stream_received = read_stream
 
 print("Listening to streams. Press CTRL-C to exit.")
 
+
+# Publish the frames still in flight and close the output streams before shutting down
+def before_shutdown():
+    if enrichment_pipeline is not None:
+        enrichment_pipeline.stop()
+
+    stream_pool.close_all()
+
+
 # Hook up to termination signal (for docker image) and CTRL-C
 # And handle graceful exit of the model.
-qx.App.run()
+qx.App.run(before_shutdown=before_shutdown)
@@ -0,0 +1,66 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import redis
+
+# Birth dates are packed as a number of days since this date
+epoch = pd.Timestamp("1970-01-01")
+
+
+class PackedRecordReader:
+    """Reads the packed records the Lookup data ingestion job writes next to the product and visitor hashes.
+
+    Each record is one integer, stored as a decimal string, so the records of a whole frame are read with one MGET
+    and decoded with a few integer operations. Products are packed as category ID << 32 | title ID, and visitors as
+    days since 1970-01-01 << 9 | 1 << 8 if the birth date is known | gender ID. IDs are resolved with dictionaries
+    kept in Redis, of which only the IDs that showed up are read and cached."""
+
+    def __init__(self, redis_client: redis.Redis):
+        self.redis_client = redis_client
+
+        # dictionary key -> {ID: value}, for the IDs read so far
+        self._dictionaries = {}
+        self._lock = threading.Lock()
+
+    def _resolve(self, dictionary_key: str, ids: np.ndarray) -> list:
+        with self._lock:
+            dictionary = self._dictionaries.setdefault(dictionary_key, {})
+
+        # IDs are only ever added, so only the IDs not read yet are read, without holding up the other workers
+        missing = [value_id for value_id in np.unique(ids).tolist() if value_id and value_id not in dictionary]
+        if missing:
+            values = self.redis_client.hmget(dictionary_key, missing)
+
+            with self._lock:
+                dictionary.update((value_id, value) for value_id, value in zip(missing, values) if value is not None)
+
+        # 0 stands for a missing value
+        return [dictionary.get(value_id) for value_id in ids.tolist()]
+
+    def _decode_products(self, packed: np.ndarray, key_prefix: str) -> list:
+        categories = self._resolve(f"{key_prefix}dictionary:category", packed >> 32)
+        titles = self._resolve(f"{key_prefix}dictionary:title", packed & 0xFFFFFFFF)
+        return [list(values) for values in zip(categories, titles)]
+
+    def _decode_visitors(self, packed: np.ndarray, key_prefix: str) -> list:
+        birthdates = (epoch + pd.to_timedelta(packed >> 9, unit="D")).strftime("%Y-%m-%d")
+        known = ((packed >> 8) & 1).astype(bool).tolist()
+        genders = self._resolve(f"{key_prefix}dictionary:gender", packed & 0xFF)
+        return [[birthdate if is_known else None, gender]
+                for birthdate, is_known, gender in zip(birthdates, known, genders)]
+
+    def get_many(self, keys: list, key_prefix: str = "") -> dict:
+        """Return the fields of the given product and visitor keys, like HMGET would, None for missing records."""
+        values = self.redis_client.mget([f"{key_prefix}packed:{key}" for key in keys])
+        found = {}
+
+        for kind, decode in (("product", self._decode_products), ("visitor", self._decode_visitors)):
+            kind_keys = [(key, value) for key, value in zip(keys, values)
+                         if value is not None and key.startswith(f"{kind}:")]
+
+            if kind_keys:
+                packed = np.array([int(value) for _, value in kind_keys], dtype="int64")
+                found.update(zip([key for key, _ in kind_keys], decode(packed, key_prefix)))
+
+        return {key: found.get(key, [None, None]) for key in keys}
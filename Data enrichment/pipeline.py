@@ -0,0 +1,52 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+
+class EnrichmentPipeline:
+    """Runs enrichment in a pool of worker threads and publishes the results in the order frames were received.
+
+    Frames are enriched concurrently, so the Redis round trips of many frames overlap. Publishing happens on a
+    single thread that waits for each frame in turn, which keeps the order of every stream. When `queue_size`
+    frames are in flight, `submit` blocks, which slows down consumption instead of buffering without limit."""
+
+    def __init__(self, enrich, publish, workers: int, queue_size: int):
+        self.enrich = enrich
+        self.publish = publish
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="enrich")
+        self._in_flight = queue.Queue(maxsize=queue_size)
+        self._publisher = threading.Thread(target=self._publish_in_order, name="publish", daemon=True)
+        self._publisher.start()
+
+    def submit(self, stream_id: str, df: pd.DataFrame):
+        future = self._executor.submit(self.enrich, df)
+
+        # Blocks while the queue is full
+        self._in_flight.put((stream_id, future))
+
+    def queue_depth(self) -> int:
+        return self._in_flight.qsize()
+
+    def _publish_in_order(self):
+        while True:
+            item = self._in_flight.get()
+
+            # Sentinel put by stop
+            if item is None:
+                return
+
+            stream_id, future = item
+
+            try:
+                self.publish(stream_id, future.result())
+            except Exception as e:
+                print(f"Error enriching frame for stream {stream_id}:", e)
+
+    def stop(self):
+        """Publish the frames in flight and stop the workers."""
+        self._in_flight.put(None)
+        self._publisher.join()
+        self._executor.shutdown()
@@ -0,0 +1,63 @@
+import threading
+import time
+from collections import OrderedDict
+
+import quixstreams as qx
+
+
+class StreamPool:
+    """Pool of output stream handles, one per stream id.
+
+    Streams are created once, with their parents set at creation. The least recently used streams are
+    closed when the pool is full, and streams that have been idle for `idle_seconds` are closed too."""
+
+    def __init__(self, producer_topic: qx.TopicProducer, max_size: int, idle_seconds: float):
+        self.producer_topic = producer_topic
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+
+        # stream id -> (stream, last used time). Most recently used streams are at the end
+        self._streams = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.closed = 0
+
+    def get_stream(self, stream_id: str, parent_id: str = None) -> qx.StreamProducer:
+        now = time.monotonic()
+
+        with self._lock:
+            if stream_id in self._streams:
+                stream = self._streams[stream_id][0]
+                self._streams.move_to_end(stream_id)
+            else:
+                stream = self.producer_topic.get_or_create_stream(stream_id)
+                if parent_id is not None:
+                    stream.properties.parents.append(parent_id)
+
+            self._streams[stream_id] = (stream, now)
+            self._evict(now)
+
+        return stream
+
+    def _evict(self, now: float):
+        # The least recently used stream is always the first one
+        while self._streams:
+            stream_id, (stream, last_used) = next(iter(self._streams.items()))
+
+            if len(self._streams) <= self.max_size and now - last_used < self.idle_seconds:
+                return
+
+            del self._streams[stream_id]
+            stream.close()
+            self.closed += 1
+
+    def size(self) -> int:
+        return len(self._streams)
+
+    def close_all(self):
+        with self._lock:
+            for stream, _ in self._streams.values():
+                stream.close()
+
+            self.closed += len(self._streams)
+            self._streams.clear()
@@ -0,0 +1,271 @@
+"""Generates lookup data and click logs at production scale, in the formats the services read.
+
+Writes `products.json` and `users.json`, read by the Lookup data ingestion job, and `omniture-logs.tsv`, replayed by the
+Clickstream producer. Everything is generated a chunk at a time, so the visitor base, catalog and number of clicks are
+only limited by disk space.
+
+- Products get the category mix of the bundled `products.json`, and their popularity follows a Zipf distribution.
+- Users get the gender mix and ages of the bundled `users.json`, with `--target-share` of the men and women in the age
+  ranges the BehaviourDetector transitions look for.
+- Clicks come in sessions of a few products, from random visitors, at `--clicks-per-second` on average.
+
+    python generate_data.py --visitors 10000000 --products 1000000 --clicks 1000000000 --output-dir generated
+
+The Lookup data ingestion job and the Clickstream producer read their files from the working directory, so run them
+from the output directory (or copy the files next to them).
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+lookup_data_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Age ranges the BehaviourDetector transitions look for, by gender
+target_age_ranges = {"M": (35, 45), "F": (25, 35)}
+
+# Columns the Clickstream producer reads from the click log
+click_log_columns = ["Unix Timestamp", "Visitor Unique ID", "IP Address", "29", "Product Page URL"]
+
+# User agents of the generated sessions, with the share of sessions using them
+user_agents = {
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0 Safari/537.36": 0.35,
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15": 0.15,
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148": 0.2,
+    "Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0 Mobile Safari/537.36": 0.2,
+    "Mozilla/5.0 (iPad; CPU OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148": 0.07,
+    "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)": 0.03,
+}
+
+
+# Method to scramble integers, so ids can be derived from an index without keeping them in memory
+def splitmix64(values: np.ndarray) -> np.ndarray:
+    with np.errstate(over="ignore"):
+        z = values.astype("uint64") + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+# Method to get the id of visitors from their index, formatted like the ids of the bundled users
+def get_visitor_ids(indices: np.ndarray) -> pd.Series:
+    indices = indices.astype("uint64")
+    high = pd.Series(splitmix64(indices)).map("{:016X}".format)
+    low = pd.Series(splitmix64(indices + np.uint64(1 << 63))).map("{:016X}".format)
+    return (high.str[:8] + "-" + high.str[8:12] + "-" + high.str[12:] + "-" + low.str[:4] + "-" + low.str[4:16])
+
+
+# Method to get the id of products from their index
+def get_product_ids(indices: np.ndarray) -> pd.Series:
+    return "VD" + pd.Series(indices + 60000000).astype(str)
+
+
+class Catalog:
+    """Categories and titles of the bundled products, used as templates for the generated ones."""
+
+    def __init__(self):
+        products = pd.read_json(os.path.join(lookup_data_dir, "products.json"))
+
+        shares = products["category"].value_counts(normalize=True)
+        self.categories = shares.index.to_numpy()
+        self.category_shares = shares.to_numpy()
+
+        # Product URLs have the category as a path segment, made of word characters only
+        self.category_slugs = pd.Series(self.categories).str.replace(r"\W", "", regex=True).to_numpy()
+
+        groups = products.groupby("category")
+        self.titles = {category: group["title"].tolist() for category, group in groups}
+        self.descriptions = {category: group["description"].tolist() for category, group in groups}
+        self.prices = products["price"].to_numpy()
+
+
+def write_products(path: str, count: int, catalog: Catalog, rng: np.random.Generator, chunk_size: int) -> np.ndarray:
+    """Write `count` products as a JSON array, and return the category index of each of them."""
+    categories = rng.choice(len(catalog.categories), size=count, p=catalog.category_shares)
+
+    with open(path, "w") as f:
+        f.write("[\n")
+
+        for start in range(0, count, chunk_size):
+            indices = np.arange(start, min(start + chunk_size, count))
+            names = catalog.categories[categories[indices]]
+            ids = get_product_ids(indices)
+
+            products = pd.DataFrame({
+                "id": ids,
+                "category": names,
+                "title": [f"{rng.choice(catalog.titles[name])} #{index}" for name, index in zip(names, indices)],
+                "description": [rng.choice(catalog.descriptions[name]) for name in names],
+                "image": ids + ".png",
+                "price": rng.choice(catalog.prices, size=len(indices)).round(2),
+            })
+
+            records = products.to_json(orient="records", lines=True).strip().replace("\n", ",\n")
+            f.write(("" if start == 0 else ",\n") + records)
+
+        f.write("\n]\n")
+
+    return categories
+
+
+def write_users(path: str, count: int, target_share: float, rng: np.random.Generator, chunk_size: int):
+    """Write `count` users as JSON lines, with the gender mix and ages of the bundled users."""
+    bundled = pd.read_json(os.path.join(lookup_data_dir, "users.json"), lines=True, dtype=False, convert_dates=False)
+
+    genders = bundled["gender"].value_counts(normalize=True, dropna=False)
+    birthdates = pd.to_datetime(bundled["birthDate"], format="%Y-%m-%d", errors="coerce")
+    missing_birthdates = birthdates.isna().mean()
+
+    today = pd.Timestamp.now().normalize()
+    ages = (today - birthdates.dropna()).dt.days.to_numpy() // 365
+
+    with open(path, "w") as f:
+        for start in range(0, count, chunk_size):
+            size = min(chunk_size, count - start)
+
+            gender = pd.Series(rng.choice(genders.index.to_numpy(dtype=object), size=size, p=genders.to_numpy()))
+            age = rng.choice(ages, size=size)
+
+            # Put a share of the men and women in the age ranges the behaviour detector looks for
+            for target_gender, (min_age, max_age) in target_age_ranges.items():
+                targeted = (gender == target_gender).to_numpy() & (rng.random(size) < target_share)
+                age[targeted] = rng.integers(min_age, max_age + 1, size=targeted.sum())
+
+            # Birthdays fall in the past year, so visitors are exactly `age` years old today
+            birthday = today - pd.to_timedelta(rng.integers(0, 365, size=size), unit="D")
+            birthdate = pd.to_datetime({"year": birthday.year - age, "month": birthday.month,
+                                        "day": np.where((birthday.month == 2) & (birthday.day == 29), 28, birthday.day)})
+            birthdate = pd.Series(birthdate.dt.strftime("%Y-%m-%d"), dtype=object)
+            birthdate[rng.random(size) < missing_birthdates] = None
+
+            users = pd.DataFrame({
+                "userId": get_visitor_ids(np.arange(start, start + size)),
+                "gender": gender,
+                "birthDate": birthdate,
+            })
+            f.write(users.to_json(orient="records", lines=True))
+
+
+class ZipfSampler:
+    """Samples indices from 0 to `count` - 1, index i having a probability proportional to 1 / (i + 1) ** `exponent`.
+
+    Ranks are shuffled, so the most popular items are spread over the catalog."""
+
+    def __init__(self, count: int, exponent: float, rng: np.random.Generator):
+        weights = 1 / np.arange(1, count + 1, dtype="float64") ** exponent
+        self.cdf = np.cumsum(weights) / weights.sum()
+        self.items = rng.permutation(count)
+        self.rng = rng
+
+    def sample(self, size: int) -> np.ndarray:
+        ranks = np.minimum(np.searchsorted(self.cdf, self.rng.random(size)), len(self.cdf) - 1)
+        return self.items[ranks]
+
+
+def write_clicks(path: str, count: int, visitors: int, product_categories: np.ndarray, catalog: Catalog,
+                 args: argparse.Namespace, rng: np.random.Generator):
+    """Write `count` clicks in the click log format, in time order, a chunk of sessions at a time.
+
+    Sessions starting in a chunk can go on past its end, so their later clicks are carried over to the next chunk, and
+    written with the clicks it generates."""
+    products = ZipfSampler(len(product_categories), args.zipf_exponent, rng)
+    agents = np.array(list(user_agents), dtype=object)
+    agent_shares = np.array(list(user_agents.values()))
+
+    started = time.monotonic()
+    chunk_start = pd.Timestamp(args.start).timestamp()
+    generated = 0
+    written = 0
+    carried = None
+
+    with open(path, "w") as f:
+        while generated < count:
+            size = min(args.chunk_size, count - generated)
+
+            # Sessions of a geometric number of clicks, the last one cut to the chunk size
+            lengths = rng.geometric(1 / args.session_length, size=size)
+            lengths = lengths[:np.searchsorted(np.cumsum(lengths), size) + 1]
+            lengths[-1] -= lengths.sum() - size
+            sessions = len(lengths)
+            session_of_click = np.repeat(np.arange(sessions), lengths)
+
+            # Sessions start at random times in the chunk, and their clicks are a few seconds apart
+            span = size / args.clicks_per_second
+            session_starts = chunk_start + rng.random(sessions) * span
+            gaps = rng.exponential(args.seconds_between_clicks, size=size)
+            gaps[np.cumsum(lengths) - lengths] = 0
+            elapsed = np.cumsum(gaps)
+            elapsed -= np.repeat(elapsed[np.cumsum(lengths) - lengths], lengths)
+            timestamps = (session_starts[session_of_click] + elapsed).astype("int64")
+
+            visitor_ids = get_visitor_ids(rng.integers(0, visitors, size=sessions, dtype="uint64"))
+            ips = rng.integers(1 << 24, 224 << 24, size=sessions)
+            ips = (pd.Series(ips >> 24).astype(str) + "." + pd.Series((ips >> 16) & 255).astype(str) + "."
+                   + pd.Series((ips >> 8) & 255).astype(str) + "." + pd.Series(ips & 255).astype(str))
+
+            product_indices = products.sample(size)
+            slugs = catalog.category_slugs[product_categories[product_indices]]
+
+            clicks = pd.DataFrame({
+                "Unix Timestamp": timestamps,
+                "Visitor Unique ID": "{" + visitor_ids.to_numpy()[session_of_click] + "}",
+                "IP Address": ips.to_numpy()[session_of_click],
+                "29": rng.choice(agents, size=sessions, p=agent_shares)[session_of_click],
+                "Product Page URL": "http://www.acme.com/" + pd.Series(slugs) + "/" + get_product_ids(product_indices),
+            }, columns=click_log_columns)
+
+            generated += size
+            chunk_start += span
+            clicks = pd.concat([carried, clicks]).sort_values("Unix Timestamp", kind="stable")
+
+            # Later chunks only have sessions starting after the end of this one, so the clicks before it are final
+            if generated < count:
+                end = np.searchsorted(clicks["Unix Timestamp"].to_numpy(), int(chunk_start))
+                carried = clicks.iloc[end:]
+                clicks = clicks.iloc[:end]
+
+            clicks.to_csv(f, sep="\t", index=False, header=written == 0)
+            written += len(clicks)
+            print(f"Generated {written} clicks ({written / (time.monotonic() - started):.0f} clicks/sec)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate lookup data and click logs at production scale")
+    parser.add_argument("--visitors", type=int, default=1000000, help="Number of users")
+    parser.add_argument("--products", type=int, default=100000, help="Number of products")
+    parser.add_argument("--clicks", type=int, default=10000000, help="Number of clicks")
+    parser.add_argument("--zipf-exponent", type=float, default=1.1, help="Skew of the product popularity")
+    parser.add_argument("--target-share", type=float, default=0.3,
+                        help="Share of the men and women in the age ranges the behaviour detector looks for")
+    parser.add_argument("--session-length", type=float, default=8, help="Average number of clicks per session")
+    parser.add_argument("--seconds-between-clicks", type=float, default=20,
+                        help="Average time between two clicks of a session")
+    parser.add_argument("--clicks-per-second", type=float, default=1000, help="Average number of clicks per second")
+    parser.add_argument("--start", default="2023-01-01", help="Date of the first clicks")
+    parser.add_argument("--chunk-size", type=int, default=1000000, help="Rows generated at a time")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output-dir", default="generated", help="Directory the files are written to")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    rng = np.random.default_rng(args.seed)
+    catalog = Catalog()
+
+    print(f"Generating {args.products} products")
+    product_categories = write_products(os.path.join(args.output_dir, "products.json"), args.products, catalog, rng,
+                                        args.chunk_size)
+
+    print(f"Generating {args.visitors} users")
+    write_users(os.path.join(args.output_dir, "users.json"), args.visitors, args.target_share, rng, args.chunk_size)
+
+    print(f"Generating {args.clicks} clicks")
+    write_clicks(os.path.join(args.output_dir, "omniture-logs.tsv"), args.clicks, args.visitors, product_categories,
+                 catalog, args, rng)
+
+    print(f"Data generated in {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,63 +1,350 @@
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import redis
 
+# Number of keys written per pipeline flush
+batch_size = int(os.environ['batch_size']) if os.environ.get('batch_size') else 1000
+
+# Number of threads flushing pipelines in parallel, each on its own connection
+workers = int(os.environ['workers']) if os.environ.get('workers') else 4
+
+# Number of users read from users.json at a time
+chunk_size = int(os.environ['chunk_size']) if os.environ.get('chunk_size') else 100000
+
+# Only write the products and users that are new or changed since the previous run, and delete the removed ones
+delta = os.environ.get('delta') == '1'
+
+# Load everything into a new versioned namespace, and switch readers to it once it is complete
+versioned = os.environ.get('versioned') == '1'
+
 r = redis.Redis(
     host=os.environ['redis_host'],
     port=int(os.environ['redis_port']),
     password=os.environ['redis_password'],
     username=os.environ['redis_username'] if 'redis_username' in os.environ else None,
+    max_connections=workers * 2,
     decode_responses=True)
 
+# Channel the enrichment service listens on to evict updated keys from its cache
+lookup_updates_channel = "lookup_updates"
 
-# Read products from products.tsv and store the category in Redis
-def load_products():
-    products = pd.read_json('products.json')
-    pipe = r.pipeline()
+# Key holding the version readers use when the lookup data is loaded into versioned namespaces
+lookup_version_key = "lookup_version"
 
-    for index, row in products.iterrows():
-        key = f'product:{row["id"]}'
-        pipe.hset(key, 'cat', row['category'])
-        pipe.hset(key, 'title', row['title'])
+# Birth dates are packed as a number of days since this date
+epoch = pd.Timestamp("1970-01-01")
 
-    pipe.execute()
-    print(f"Imported {len(products)} products")
 
+class HashWriter:
+    """Writes hashes to Redis in pipelines of `batch_size` keys, flushed in parallel by a pool of threads.
+
+    With `replace`, each batch is written in a transaction, every key is deleted before it is written so removed
+    fields do not linger, and the keys are announced on the lookup updates channel."""
+
+    def __init__(self, name: str, replace: bool = False):
+        self.name = name
+        self.replace = replace
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = []
+        self.batch = []
+        self.written = 0
+        self.started = time.monotonic()
+        self.last_report = self.started
+
+    def write(self, key: str, mapping: dict, packed: tuple, fingerprint: tuple = None):
+        """Write a hash and its packed record, a (key, value). `fingerprint` is a (hash, field, value) to store with
+        them, in the same batch."""
+        self.batch.append((key, mapping, packed, fingerprint))
+
+        if len(self.batch) == batch_size:
+            self.flush()
 
-# Read visitor data from users.tsv and store gender, birthday and age in Redis
-def load_users():
-    users = pd.read_json('users.json', lines=True)
-    total_users = len(users)
-    imported_users = 0
-    pipe = r.pipeline()
-    for _, row in users.iterrows():
-        key = f'visitor:{row["userId"]}'
+    def delete(self, key: str, packed_key: str, fingerprint: tuple = None):
+        """Delete a hash and its packed record. `fingerprint` is a (hash, field) to delete with them, in the same
+        batch."""
+        self.write(key, None, (packed_key, None), fingerprint and (*fingerprint, None))
 
-        # Birthday may not be present, check for NaN
-        if not pd.isna(row['birthDate']):
-            pipe.hset(key, 'birthday', row['birthDate'])
+    def flush(self):
+        if self.batch:
+            self.pending.append(self.executor.submit(write_hashes, self.batch, self.replace))
+            self.batch = []
 
-        # Age may not be present, check for NaN
-        if not pd.isna(row['gender']):
-            pipe.hset(key, 'gender', row['gender'])
+        # Keep a bounded number of batches in flight, so reading does not run ahead of writing
+        while len(self.pending) > workers * 2 or (self.pending and self.pending[0].done()):
+            self.written += self.pending.pop(0).result()
 
-        imported_users += 1
+        self.report_progress()
 
-        if imported_users % 1000 == 0:
-            pipe.execute()
-            print(f"Imported {imported_users} of {total_users} users")
+    def report_progress(self):
+        now = time.monotonic()
+        if now - self.last_report >= 5:
+            print(f"Imported {self.written} {self.name} ({self.written / (now - self.started):.0f} keys/sec)")
+            self.last_report = now
+
+    def close(self) -> int:
+        self.flush()
+        for future in self.pending:
+            self.written += future.result()
+
+        self.pending = []
+        self.executor.shutdown()
+        return self.written
+
+
+# Write a batch of hashes with a single multi-field HSET per key, in one round trip
+def write_hashes(batch: list, replace: bool) -> int:
+    pipe = r.pipeline(transaction=replace)
+
+    for key, mapping, (packed_key, packed_value), fingerprint in batch:
+        if replace or not mapping:
+            pipe.delete(key)
+
+        if mapping:
+            pipe.hset(key, mapping=mapping)
+
+        if packed_value is None:
+            pipe.delete(packed_key)
+        else:
+            pipe.set(packed_key, packed_value)
+
+        if fingerprint:
+            fingerprint_key, field, value = fingerprint
+            if value is None:
+                pipe.hdel(fingerprint_key, field)
+            else:
+                pipe.hset(fingerprint_key, field, value)
+
+    if replace:
+        pipe.publish(lookup_updates_channel, "\n".join(key for key, _, _, _ in batch))
 
-    # Last execute to flush the pipeline
     pipe.execute()
+    return len(batch)
+
+
+# Turn a frame into (key, mapping) pairs, leaving out the fields that are NaN
+def to_hashes(df: pd.DataFrame, key_prefix: str, key_column: str, fields: dict):
+    keys = key_prefix + df[key_column].astype(str)
+    values = df[list(fields)].rename(columns=fields)
+    present = values.notna()
+
+    # Rows are grouped by which fields they have, so NaN fields are dropped without looking at every value
+    for pattern, rows in present.groupby(list(present.columns)).groups.items():
+        columns = [column for column, has_value in zip(present.columns, pattern) if has_value]
+        if columns:
+            yield from zip(keys[rows], values.loc[rows, columns].to_dict('records'))
+        else:
+            yield from zip(keys[rows], [{}] * len(rows))
+
+
+def hash_ids(ids: pd.Series) -> np.ndarray:
+    return pd.util.hash_pandas_object(ids.astype(str), index=False).to_numpy()
+
+
+class Dictionary:
+    """Integer IDs of the distinct values of a field, kept in a Redis hash (ID -> value).
+
+    IDs are only ever added, so packed records written by previous runs stay valid. 0 stands for a missing value."""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.ids = {value: int(value_id) for value_id, value in r.hgetall(key).items()}
+
+    def encode(self, values: pd.Series) -> np.ndarray:
+        new_values = [value for value in values.dropna().unique() if value not in self.ids]
+
+        if new_values:
+            # New IDs are stored before any record using them is written
+            added = {value: len(self.ids) + 1 + i for i, value in enumerate(new_values)}
+            r.hset(self.key, mapping={value_id: value for value, value_id in added.items()})
+            self.ids.update(added)
+
+        return values.map(self.ids).fillna(0).astype('int64').to_numpy()
+
+
+# Method to pack the category and title IDs of products into one integer: category ID << 32 | title ID
+def pack_products(products: pd.DataFrame, dictionaries: dict) -> np.ndarray:
+    return (dictionaries['category'].encode(products['category']) << 32) | dictionaries['title'].encode(products['title'])
+
+
+# Method to pack the birth date and gender of users into one integer:
+# days since 1970-01-01 << 9 | 1 << 8 if the birth date is known | gender ID
+def pack_users(users: pd.DataFrame, dictionaries: dict) -> np.ndarray:
+    days = (pd.to_datetime(users['birthDate'], format='%Y-%m-%d', errors='coerce') - epoch).dt.days
+    has_birthdate = days.notna().to_numpy().astype('int64')
+    days = days.fillna(0).astype('int64').to_numpy()
+
+    return (days << 9) | (has_birthdate << 8) | dictionaries['gender'].encode(users['gender'])
+
+
+# Method to get the packed record key and value of each hash key of a chunk. Packed records are stored as decimal
+# strings next to the hashes, so readers get everything they need for a record with one GET
+def pack(chunk: pd.DataFrame, packer, dictionaries: dict, namespace: str, key_prefix: str, key_column: str) -> dict:
+    ids = chunk[key_column].astype(str)
+    packed_keys = namespace + 'packed:' + key_prefix + ids
+    packed_values = packer(chunk, dictionaries).astype(str)
+
+    return dict(zip(namespace + key_prefix + ids, zip(packed_keys, packed_values)))
+
+
+# Write every record of the chunks
+def load_all(name: str, chunks, namespace: str, key_prefix: str, key_column: str, fields: dict, packer,
+             dictionaries: dict) -> int:
+    writer = HashWriter(name)
+
+    for chunk in chunks:
+        packed = pack(chunk, packer, dictionaries, namespace, key_prefix, key_column)
+
+        for key, mapping in to_hashes(chunk, namespace + key_prefix, key_column, fields):
+            if mapping:
+                writer.write(key, mapping, packed[key])
+
+    return writer.close()
+
+
+# Write only the records whose fingerprint (a hash of their fields) changed since the previous run,
+# and delete the records that are no longer there. Fingerprints are kept in a Redis hash per kind of record
+def load_delta(name: str, chunks, key_prefix: str, key_column: str, fields: dict, packer, dictionaries: dict) -> int:
+    fingerprint_key = f"fingerprints:{key_prefix}"
+    writer = HashWriter(name, replace=True)
+    seen = []
+
+    for chunk in chunks:
+        ids = chunk[key_column].astype(str).to_numpy()
+        fingerprints = pd.util.hash_pandas_object(chunk[list(fields)], index=False).astype(str).to_numpy()
+        seen.append(hash_ids(chunk[key_column]))
+
+        pipe = r.pipeline(transaction=False)
+        for start in range(0, len(ids), batch_size):
+            pipe.hmget(fingerprint_key, ids[start:start + batch_size].tolist())
+        previous = np.concatenate([np.array(values, dtype=object) for values in pipe.execute()] or [[]])
+
+        changed = fingerprints != previous
+        changed_fingerprints = dict(zip(ids[changed], fingerprints[changed]))
+        packed = pack(chunk[changed], packer, dictionaries, '', key_prefix, key_column)
+
+        for key, mapping in to_hashes(chunk[changed], key_prefix, key_column, fields):
+            record_id = key[len(key_prefix):]
+            fingerprint = (fingerprint_key, record_id, changed_fingerprints[record_id])
+
+            # Records without any field are deleted, but keep their fingerprint so they are not written again
+            writer.write(key, mapping, packed[key] if mapping else (packed[key][0], None), fingerprint)
+
+    # Records with a fingerprint from a previous run that were not seen in this one have been removed
+    seen = np.sort(np.concatenate(seen)) if seen else np.array([], dtype="uint64")
+    removed = []
+
+    for record_id, _ in r.hscan_iter(fingerprint_key, count=batch_size):
+        removed.append(record_id)
+
+        if len(removed) == batch_size:
+            delete_removed(writer, removed, seen, key_prefix, fingerprint_key)
+            removed = []
+
+    delete_removed(writer, removed, seen, key_prefix, fingerprint_key)
+    return writer.close()
+
+
+def delete_removed(writer: HashWriter, record_ids: list, seen: np.ndarray, key_prefix: str, fingerprint_key: str):
+    if not record_ids:
+        return
+
+    record_ids = pd.Series(record_ids)
+    for record_id in record_ids[~np.isin(hash_ids(record_ids), seen)]:
+        writer.delete(key_prefix + record_id, 'packed:' + key_prefix + record_id, (fingerprint_key, record_id))
+
+
+# Method to leave out the rows without a key, which cannot be stored or looked up
+def drop_missing_keys(chunks, key_column: str):
+    for chunk in chunks:
+        yield chunk[chunk[key_column].notna()]
+
+
+def load(name: str, chunks, key_prefix: str, key_column: str, fields: dict, packer, dictionary_fields: list,
+         namespace: str) -> int:
+    # Text values of the packed records are stored as IDs, with one dictionary per field
+    dictionaries = {field: Dictionary(f"{namespace}dictionary:{field}") for field in dictionary_fields}
+    chunks = drop_missing_keys(chunks, key_column)
+
+    if delta and not versioned:
+        return load_delta(name, chunks, key_prefix, key_column, fields, packer, dictionaries)
+
+    return load_all(name, chunks, namespace, key_prefix, key_column, fields, packer, dictionaries)
+
+
+# Read products from products.json and store the category and title in Redis
+def load_products(namespace: str = ''):
+    products = pd.read_json('products.json', dtype=False)
+    total_products = load("products", [products], 'product:', 'id', {'category': 'cat', 'title': 'title'},
+                          pack_products, ['category', 'title'], namespace)
+    print(f"Imported {total_products} products")
+
+
+# Read visitor data from users.json, a chunk at a time, and store gender and birthday in Redis
+def load_users(namespace: str = ''):
+    with pd.read_json('users.json', lines=True, chunksize=chunk_size, dtype=False, convert_dates=False) as users:
+        # Birthday and gender may not be present, NaN fields are not written
+        total_users = load("users", users, 'visitor:', 'userId', {'birthDate': 'birthday', 'gender': 'gender'},
+                           pack_users, ['gender'], namespace)
+
     print(f"Imported all {total_users} users")
 
 
+# Delete every key of a versioned namespace
+def delete_namespace(namespace: str):
+    keys = []
+
+    for key in r.scan_iter(match=f"{namespace}*", count=batch_size):
+        keys.append(key)
+
+        if len(keys) == batch_size:
+            r.unlink(*keys)
+            keys = []
+
+    if keys:
+        r.unlink(*keys)
+
+
 def main():
-    print("Importing products...")
-    load_products()
+    if not versioned:
+        # Readers only look at the version `lookup_version` points to, so they would never see unversioned keys
+        current_version = r.get(lookup_version_key)
+        if current_version:
+            raise SystemExit(f"The lookup data is versioned (version {current_version}), set versioned to '1', or "
+                             f"delete the {lookup_version_key} key to go back to unversioned loads")
+
+        print("Importing products...")
+        load_products()
+        if not delta:
+            r.publish(lookup_updates_channel, 'product:*')
+
+        print("Importing users...")
+        load_users()
+        if not delta:
+            r.publish(lookup_updates_channel, 'visitor:*')
+        return
+
+    # Readers keep using the current version until the new one is complete
+    current_version = int(r.get(lookup_version_key) or 0)
+    version = current_version + 1
+    namespace = f"v{version}:"
+
+    print(f"Importing products into {namespace}...")
+    load_products(namespace)
+
+    print(f"Importing users into {namespace}...")
+    load_users(namespace)
+
+    # Switch every reader to the new version at once
+    r.set(lookup_version_key, version)
+    r.publish(lookup_updates_channel, '*')
+    print(f"Switched to version {version}")
 
-    print("Importing users...")
-    load_users()
+    # The previous version is kept for readers that have not switched yet, older ones are deleted
+    if current_version > 1:
+        delete_namespace(f"v{current_version - 1}:")
 
 
 if __name__ == '__main__':